@@ -1,11 +1,23 @@
 import os
+import time
+import queue
 import logging
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from tkinterdnd2 import DND_FILES, TkinterDnD
 
-from fallback_handler import heic_to_pdf_with_fallback
+from fallback_handler import (
+    SUPPORTED_FORMATS, ConversionError, convert_folder_to_pdf, parse_color
+)
+from history_store import ConversionHistory
+from metrics import format_summary
+
+# Entries shown per page in the history viewer
+HISTORY_PAGE_SIZE = 100
+# How often the GUI drains the conversion event queue
+POLL_INTERVAL_MS = 100
 
 class DragDropEntry(tk.Entry):
     """Custom Entry widget with drag and drop support."""
@@ -30,6 +42,127 @@ class DragDropEntry(tk.Entry):
     def paste(self):
         self.event_generate('<<Paste>>')
 
+class ConversionRunner:
+    """Run a conversion in a background thread and relay its events to Tk.
+
+    The worker thread only puts events on a queue; the Tk main loop polls
+    it with root.after() and is the only place widgets are touched.
+    """
+    def __init__(self, root, progress_bar, status_label, on_finish=None):
+        self.root = root
+        self.progress_bar = progress_bar
+        self.status_label = status_label
+        self.on_finish = on_finish
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.thread = None
+        self.started_at = None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, **conversion_kwargs):
+        """Start convert_folder_to_pdf() with the given arguments."""
+        self.cancel_event.clear()
+        self.started_at = time.monotonic()
+        self.thread = threading.Thread(
+            target=self._work, kwargs=conversion_kwargs, daemon=True
+        )
+        self.thread.start()
+        self.root.after(POLL_INTERVAL_MS, self._poll)
+
+    def cancel(self):
+        """Ask the conversion to stop at the next page boundary."""
+        if self.is_running():
+            self.cancel_event.set()
+            self.status_label.config(text="Cancelling...")
+
+    def _work(self, **conversion_kwargs):
+        try:
+            result = convert_folder_to_pdf(
+                progress_callback=self._on_progress,
+                confirm_issues=self._confirm_issues,
+                cancel_event=self.cancel_event,
+                **conversion_kwargs
+            )
+            self.events.put(('done', result))
+        except ConversionError as e:
+            self.events.put(('error', e))
+        except Exception as e:
+            logging.error(f"Unexpected conversion failure: {e}", exc_info=True)
+            self.events.put(('error', ConversionError(str(e))))
+
+    def _on_progress(self, done, total, message, bytes_done):
+        self.events.put(('progress', done, total, message, bytes_done, time.monotonic()))
+
+    def _confirm_issues(self, conversion_issues):
+        # Runs in the worker thread; the answer comes back from the Tk loop
+        reply = queue.Queue(maxsize=1)
+        self.events.put(('confirm', conversion_issues, reply))
+        return reply.get()
+
+    def _poll(self):
+        try:
+            while True:
+                event = self.events.get_nowait()
+                if event[0] == 'progress':
+                    self._show_progress(*event[1:])
+                elif event[0] == 'confirm':
+                    self._ask_confirmation(*event[1:])
+                else:
+                    self._finish(*event)
+                    return
+        except queue.Empty:
+            pass
+        self.root.after(POLL_INTERVAL_MS, self._poll)
+
+    def _show_progress(self, done, total, message, bytes_done, reported_at):
+        self.progress_bar["maximum"] = max(total, 1)
+        self.progress_bar["value"] = done
+        if done == 0:
+            # Page throughput is measured from the start of page conversion
+            self.started_at = reported_at
+            self.status_label.config(text=message)
+            return
+
+        elapsed = max(reported_at - self.started_at, 1e-6)
+        pages_per_sec = done / elapsed
+        mb_per_sec = bytes_done / elapsed / (1024 * 1024)
+        eta = timedelta(seconds=int((total - done) / pages_per_sec))
+        self.status_label.config(
+            text=f"{message} - {pages_per_sec:.1f} pages/s, "
+                 f"{mb_per_sec:.1f} MB/s, ETA {eta}"
+        )
+
+    def _ask_confirmation(self, conversion_issues, reply):
+        issues_text = "\n".join(
+            f"{fname}: {', '.join(issues)}"
+            for fname, issues in conversion_issues.items()
+        )
+        reply.put(messagebox.askyesno("Potential Issues",
+            f"The following issues were detected:\n\n{issues_text}\n\nContinue anyway?"))
+
+    def _finish(self, kind, payload):
+        self.progress_bar["value"] = 0
+        self.status_label.config(text="Ready")
+        if kind == 'error':
+            messagebox.showerror("Error", str(payload))
+            if payload.report_path:
+                messagebox.showinfo("Error Report",
+                    f"An error report has been generated at:\n{payload.report_path}")
+        elif payload['status'] == 'no_files':
+            messagebox.showwarning("No Files", "No matching files found!")
+        elif payload['status'] == 'up_to_date':
+            messagebox.showinfo("Info", "All files are up to date!")
+        elif payload['status'] == 'cancelled':
+            messagebox.showinfo("Cancelled",
+                f"Conversion cancelled after {payload['pages']} pages.")
+        elif payload['status'] == 'converted':
+            self.status_label.config(text=f"Done: {format_summary(payload['metrics'])}")
+            messagebox.showinfo("Success", f"PDF created successfully: {payload['output']}")
+        if self.on_finish:
+            self.on_finish()
+
 def browse_folder(entry_field):
     """Open a folder browser dialog and set the selected folder path."""
     folder_path = filedialog.askdirectory()
@@ -48,11 +181,14 @@ def browse_file(entry_field):
         entry_field.insert(0, file_path)
 
 def start_conversion(
-    input_entry, output_entry, quality_entry, progress_bar, status_label,
+    input_entry, output_entry, quality_entry, runner,
     recursive=True, min_date=None, skip_converted=True, delete_source=False,
-    pdf_options=None
+    pdf_options=None, workers=None, append=False, shard_pages=None
 ):
-    """Start the HEIC, JPEG, PNG, BMP, and GIF to PDF conversion process."""
+    """Start the HEIC, JPEG, PNG, BMP, GIF and TIFF to PDF conversion process.
+
+    Returns True when the conversion was started in the background.
+    """
     input_folder = input_entry.get()
     output_pdf = output_entry.get()
     try:
@@ -62,23 +198,25 @@ def start_conversion(
             "Invalid Input",
             "Compression quality must be an integer!"
         )
-        return
+        return False
 
     if not input_folder or not output_pdf:
         messagebox.showerror(
             "Missing Input",
             "Please provide both input folder and output PDF path!"
         )
-        return
+        return False
 
-    # Call the function from fallback_handler
-    supported_formats = (".heic", ".jpeg", ".jpg", ".png", ".bmp", ".gif")
-    heic_to_pdf_with_fallback(
-        input_folder, output_pdf, compression_quality, supported_formats,
-        progress_bar, status_label, pdf_options=pdf_options,
+    # Run the conversion from fallback_handler off the Tk main thread
+    runner.start(
+        input_folder=input_folder, output_pdf=output_pdf,
+        compression_quality=compression_quality,
+        supported_formats=SUPPORTED_FORMATS, pdf_options=pdf_options,
         recursive=recursive, min_date=min_date,
-        skip_converted=skip_converted, delete_source=delete_source
+        skip_converted=skip_converted, delete_source=delete_source,
+        workers=workers, append=append, shard_pages=shard_pages
     )
+    return True
 
 def show_error_logs():
     """Display error logs in a new window."""
@@ -111,7 +249,7 @@ def show_error_logs():
 def create_gui():
     """Create the tkinter GUI with PDF customization options."""
     root = TkinterDnD.Tk()  # Use TkinterDnD instead of regular Tk
-    root.title("HEIC, JPEG, PNG, BMP, GIF to PDF Converter")
+    root.title("HEIC, JPEG, PNG, BMP, GIF, TIFF to PDF Converter")
 
     # Keyboard shortcuts
     def handle_shortcuts(event):
@@ -200,12 +338,31 @@ def create_gui():
         variable=skip_converted_var
     ).pack(side=tk.LEFT, padx=5)
 
+    append_var = tk.BooleanVar(value=False)
+    tk.Checkbutton(
+        options_frame, text="Append to existing PDF",
+        variable=append_var
+    ).pack(side=tk.LEFT, padx=5)
+
     delete_source_var = tk.BooleanVar(value=False)
     tk.Checkbutton(
         options_frame, text="Delete source files",
         variable=delete_source_var
     ).pack(side=tk.LEFT, padx=5)
 
+    # Parallel decode/encode workers
+    tk.Label(options_frame, text="Workers:").pack(side=tk.LEFT, padx=5)
+    workers_var = tk.StringVar(value=str(os.cpu_count() or 1))
+    tk.Spinbox(
+        options_frame, from_=1, to=max(os.cpu_count() or 1, 64),
+        textvariable=workers_var, width=4
+    ).pack(side=tk.LEFT, padx=5)
+
+    # Split big batches into name_001.pdf, name_002.pdf, ...
+    tk.Label(options_frame, text="Pages per PDF:").pack(side=tk.LEFT, padx=5)
+    shard_pages_var = tk.StringVar(value="")
+    ttk.Entry(options_frame, textvariable=shard_pages_var, width=6).pack(side=tk.LEFT, padx=5)
+
     # Progress bar
     progress_bar = ttk.Progressbar(
         root, orient="horizontal", length=400, mode="determinate"
@@ -257,11 +414,41 @@ def create_gui():
 
     size_var.trace('w', toggle_custom_size)
 
+    # Target resolution for downsampling
+    tk.Label(pdf_frame, text="Target DPI:").pack(side=tk.LEFT, padx=5)
+    dpi_var = tk.StringVar(value="Original")
+    ttk.Combobox(
+        pdf_frame, textvariable=dpi_var,
+        values=["Original", "150", "300"], width=8
+    ).pack(side=tk.LEFT, padx=5)
+
+    # Size budget; the quality above becomes the highest quality tried
+    tk.Label(pdf_frame, text="Max PDF size (MB):").pack(side=tk.LEFT, padx=5)
+    max_size_var = tk.StringVar(value="")
+    ttk.Entry(pdf_frame, textvariable=max_size_var, width=6).pack(side=tk.LEFT, padx=5)
+
     # Watermark
     watermark_var = tk.StringVar()
     tk.Label(pdf_frame, text="Watermark:").pack(side=tk.LEFT, padx=5)
     ttk.Entry(pdf_frame, textvariable=watermark_var, width=15).pack(side=tk.LEFT, padx=5)
 
+    # Image watermark
+    watermark_image_var = tk.StringVar()
+
+    def choose_watermark_image():
+        path = filedialog.askopenfilename(
+            filetypes=[("Images", "*.png *.jpg *.jpeg *.bmp *.gif")]
+        )
+        if path:
+            watermark_image_var.set(path)
+
+    tk.Label(pdf_frame, text="Watermark Image:").pack(side=tk.LEFT, padx=5)
+    ttk.Entry(pdf_frame, textvariable=watermark_image_var, width=15).pack(side=tk.LEFT, padx=5)
+    ttk.Button(
+        pdf_frame, text="Browse",
+        command=choose_watermark_image
+    ).pack(side=tk.LEFT)
+
     # Page numbers
     page_numbers_var = tk.BooleanVar(value=False)
     ttk.Checkbutton(
@@ -269,6 +456,13 @@ def create_gui():
         variable=page_numbers_var
     ).pack(side=tk.LEFT, padx=5)
 
+    # Long images over several pages
+    split_long_var = tk.BooleanVar(value=False)
+    ttk.Checkbutton(
+        pdf_frame, text="Split Long Images",
+        variable=split_long_var
+    ).pack(side=tk.LEFT, padx=5)
+
     # PDF Merging
     merge_var = tk.BooleanVar(value=False)
     merge_files = []
@@ -299,11 +493,14 @@ def create_gui():
 
     # Background color
     bg_color_var = tk.StringVar()
-    tk.Label(pdf_frame, text="Background Color:").pack(side=tk.LEFT, padx=5)
+    tk.Label(pdf_frame, text="Background Color (R,G,B):").pack(side=tk.LEFT, padx=5)
     ttk.Entry(pdf_frame, textvariable=bg_color_var, width=15).pack(side=tk.LEFT, padx=5)
 
     # Update start_conversion to use new options
     def enhanced_start_conversion():
+        if runner.is_running():
+            return
+
         try:
             min_date = None
             if date_var.get():
@@ -312,34 +509,98 @@ def create_gui():
             messagebox.showerror("Error", "Invalid date format. Use YYYY-MM-DD")
             return
 
+        try:
+            workers = int(workers_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "Workers must be an integer!")
+            return
+
+        try:
+            shard_pages = int(shard_pages_var.get()) if shard_pages_var.get() else None
+        except ValueError:
+            messagebox.showerror("Error", "Pages per PDF must be an integer!")
+            return
+        if shard_pages and append_var.get():
+            messagebox.showerror("Error", "Appending cannot be combined with Pages per PDF!")
+            return
+        if shard_pages and split_long_var.get():
+            messagebox.showerror("Error", "Split Long Images cannot be combined with Pages per PDF!")
+            return
+
+        try:
+            target_dpi = None
+            if dpi_var.get() not in ("", "Original"):
+                target_dpi = int(dpi_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "Target DPI must be an integer!")
+            return
+
+        try:
+            max_pdf_bytes = None
+            if max_size_var.get():
+                max_pdf_bytes = int(float(max_size_var.get()) * 1024 * 1024)
+        except ValueError:
+            messagebox.showerror("Error", "Max PDF size must be a number!")
+            return
+
+        try:
+            background_color = parse_color(bg_color_var.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+
         pdf_options = {
             'orientation': orientation_var.get(),
             'page_size': size_var.get(),
             'custom_size': (int(width_var.get()), int(height_var.get()))
                           if size_var.get() == "Custom" else None,
+            'target_dpi': target_dpi,
+            'max_pdf_bytes': max_pdf_bytes,
             'watermark': watermark_var.get() or None,
+            'watermark_image': watermark_image_var.get() or None,
             'page_numbers': page_numbers_var.get(),
+            'split_long_images': split_long_var.get(),
             'merge_files': merge_files if merge_var.get() else None,
             'font': font_var.get() or None,
-            'background_color': bg_color_var.get() or None
+            'background_color': background_color
         }
 
-        start_conversion(
-            input_entry, output_entry, quality_entry,
-            progress_bar, status_label,
+        started = start_conversion(
+            input_entry, output_entry, quality_entry, runner,
             recursive=recursive_var.get(),
             min_date=min_date,
             skip_converted=skip_converted_var.get(),
             delete_source=delete_source_var.get(),
-            pdf_options=pdf_options
+            pdf_options=pdf_options,
+            workers=workers,
+            append=append_var.get(),
+            shard_pages=shard_pages
         )
+        if started:
+            convert_btn.config(state=tk.DISABLED)
+            cancel_btn.config(state=tk.NORMAL)
+
+    def conversion_finished():
+        convert_btn.config(state=tk.NORMAL)
+        cancel_btn.config(state=tk.DISABLED)
+
+    runner = ConversionRunner(
+        root, progress_bar, status_label, on_finish=conversion_finished
+    )
 
     # Update Convert button with shortcut hint
+    button_frame = tk.Frame(root)
+    button_frame.grid(row=5, column=0, columnspan=3, pady=10)
     convert_btn = tk.Button(
-        root, text="Convert (Ctrl+Enter)",
+        button_frame, text="Convert (Ctrl+Enter)",
         command=enhanced_start_conversion
     )
-    convert_btn.grid(row=5, column=0, columnspan=3, pady=10)
+    convert_btn.pack(side=tk.LEFT, padx=5)
+    cancel_btn = tk.Button(
+        button_frame, text="Cancel", state=tk.DISABLED,
+        command=runner.cancel
+    )
+    cancel_btn.pack(side=tk.LEFT, padx=5)
 
     # Keyboard shortcut label
     shortcuts_text = """
@@ -357,17 +618,49 @@ def create_gui():
 
     # Add history viewer button
     def show_history():
-        history = load_conversion_history()
+        history = ConversionHistory()
         history_window = tk.Toplevel(root)
         history_window.title("Conversion History")
 
+        # Page navigation
+        nav_frame = ttk.Frame(history_window)
+        nav_frame.pack(side=tk.BOTTOM, fill='x')
+        page_label = tk.Label(nav_frame)
+        current_page = [0]
+
         text = tk.Text(history_window, wrap=tk.WORD)
         text.pack(expand=True, fill='both')
 
-        for file_hash, info in history.items():
-            text.insert('end', f"File: {info['path']}\n")
-            text.insert('end', f"Converted: {datetime.fromtimestamp(info['timestamp'])}\n")
-            text.insert('end', f"Output: {info['output']}\n\n")
+        def render_page():
+            total = history.count()
+            pages = max(1, (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE)
+            current_page[0] = min(max(current_page[0], 0), pages - 1)
+
+            text.delete('1.0', 'end')
+            entries = history.page(current_page[0] * HISTORY_PAGE_SIZE, HISTORY_PAGE_SIZE)
+            for info in entries:
+                text.insert('end', f"File: {info['path']}\n")
+                text.insert('end', f"Converted: {datetime.fromtimestamp(info['timestamp'])}\n")
+                text.insert('end', f"Output: {info['output']}\n\n")
+            page_label.config(text=f"Page {current_page[0] + 1} of {pages} ({total} entries)")
+
+        def change_page(step):
+            current_page[0] += step
+            render_page()
+
+        def close_history():
+            history.close()
+            history_window.destroy()
+
+        ttk.Button(
+            nav_frame, text="< Previous", command=lambda: change_page(-1)
+        ).pack(side=tk.LEFT, padx=5, pady=5)
+        page_label.pack(side=tk.LEFT, expand=True)
+        ttk.Button(
+            nav_frame, text="Next >", command=lambda: change_page(1)
+        ).pack(side=tk.RIGHT, padx=5, pady=5)
+        history_window.protocol("WM_DELETE_WINDOW", close_history)
+        render_page()
 
     history_btn = tk.Button(root, text="View History", command=show_history)
     history_btn.grid(row=8, column=0, columnspan=3, pady=5)
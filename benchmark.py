@@ -0,0 +1,279 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import statistics
+import platform
+import argparse
+import tempfile
+from datetime import datetime
+
+from PIL import Image
+
+from metrics import get_peak_rss_mb
+
+# (width, height) choices for the synthetic corpus, from thumbnails to
+# 12 MP phone photos
+RESOLUTIONS = [(640, 480), (1280, 960), (1920, 1080), (3024, 4032), (4032, 3024)]
+CORPUS_FORMATS = [("jpg", "JPEG"), ("png", "PNG"), ("bmp", "BMP"), ("gif", "GIF")]
+# Slowdowns shorter than this are timer noise, not regressions
+MIN_REGRESSION_SECONDS = 0.01
+
+def generate_corpus(directory, count, seed=0):
+    """Write count synthetic images of mixed formats and sizes to directory."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        width, height = rng.choice(RESOLUTIONS)
+        ext, image_format = CORPUS_FORMATS[i % len(CORPUS_FORMATS)]
+
+        # Gradients plus noise compress roughly like photos
+        gradient = Image.linear_gradient('L').resize((width, height))
+        noise = Image.effect_noise((width, height), rng.uniform(10, 60))
+        image = Image.merge(
+            'RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT))
+        )
+        if image_format == "GIF":
+            image = image.convert('P')
+        path = os.path.join(directory, f"bench_{i:05d}.{ext}")
+        if image_format == "JPEG":
+            image.save(path, image_format, quality=rng.choice([75, 90, 95]))
+        else:
+            image.save(path, image_format)
+
+def copy_heic_samples(heic_dir, directory):
+    """Copy real HEIC samples into the corpus; Pillow cannot write HEIC."""
+    for name in os.listdir(heic_dir):
+        if name.lower().endswith(".heic"):
+            shutil.copy(os.path.join(heic_dir, name), directory)
+
+def stage_result(seconds, items, nbytes):
+    """Summarize one stage as time and throughput."""
+    seconds = max(seconds, 1e-9)
+    return {
+        'seconds': round(seconds, 4),
+        'items': items,
+        'items_per_sec': round(items / seconds, 2),
+        'mb_per_sec': round(nbytes / seconds / (1024 * 1024), 2),
+        'bytes': nbytes
+    }
+
+def median_results(runs):
+    """Combine repeated runs into one result with each stage's median time."""
+    def combine(stages):
+        first = stages[0]
+        if 'seconds' not in first:
+            return {name: combine([stage[name] for stage in stages]) for name in first}
+        seconds = statistics.median(stage['seconds'] for stage in stages)
+        return stage_result(seconds, first['items'], first['bytes'])
+
+    results = dict(runs[-1])
+    results['stages'] = {
+        name: combine([run['stages'][name] for run in runs])
+        for name in runs[-1]['stages']
+    }
+    results['peak_rss_mb'] = max(
+        (run['peak_rss_mb'] for run in runs if run['peak_rss_mb'] is not None),
+        default=None
+    )
+    return results
+
+def run_benchmark(corpus_dir, work_dir, quality, workers, target_dpi):
+    """Time each pipeline stage over corpus_dir and return the results dict."""
+    import fallback_handler as fh
+
+    results = {'stages': {}}
+    stages = results['stages']
+    pdf_options = {'target_dpi': target_dpi}
+    # Every run starts cold, without fingerprints or cached pages
+    shutil.rmtree(fh.CONVERSION_CACHE, ignore_errors=True)
+
+    # Scan, once with an empty fingerprint index and once with a warm one
+    start = time.perf_counter()
+    files_info = fh.scan_directory(corpus_dir, fh.SUPPORTED_FORMATS)
+    total_bytes = sum(f['size'] for f in files_info)
+    stages['scan_cold'] = stage_result(time.perf_counter() - start, len(files_info), total_bytes)
+    start = time.perf_counter()
+    fh.scan_directory(corpus_dir, fh.SUPPORTED_FORMATS)
+    stages['scan_warm'] = stage_result(time.perf_counter() - start, len(files_info), total_bytes)
+    files_info.sort(key=lambda x: x['path'])
+
+    start = time.perf_counter()
+    for file_info in files_info:
+        fh.check_image_issues(file_info['path'])
+    stages['check_issues'] = stage_result(time.perf_counter() - start, len(files_info), total_bytes)
+
+    # Decode per format, then encode what was decoded, with the same
+    # functions the workers run
+    pdf = fh.create_pdf(pdf_options)
+    max_pixels = fh.get_image_box_pixels(pdf, 'P', target_dpi)
+    decode_times = {}
+    encode_time = 0.0
+    pages = []
+    for file_info in files_info:
+        file_path = file_info['path']
+        image_format = os.path.splitext(file_path)[1].lower().lstrip('.')
+        start = time.perf_counter()
+        image, encoder = fh.decode_page_image(file_path, max_pixels)
+        elapsed, count, nbytes = decode_times.get(image_format, (0.0, 0, 0))
+        decode_times[image_format] = (
+            elapsed + time.perf_counter() - start, count + 1, nbytes + file_info['size']
+        )
+
+        start = time.perf_counter()
+        pages.append(fh.encode_page(image, quality, encoder=encoder))
+        encode_time += time.perf_counter() - start
+        image.close()
+
+    stages['decode'] = {
+        image_format: stage_result(*values)
+        for image_format, values in sorted(decode_times.items())
+    }
+    encoded_bytes = sum(len(data) for data, _ in pages)
+    stages['encode'] = stage_result(encode_time, len(pages), encoded_bytes)
+
+    start = time.perf_counter()
+    for data, size in pages:
+        fh.add_image_page(pdf, data, size, 'P')
+    stages['page_add'] = stage_result(time.perf_counter() - start, len(pages), encoded_bytes)
+    del pages
+
+    output_pdf = os.path.join(work_dir, "bench_output.pdf")
+    start = time.perf_counter()
+    pdf.output(output_pdf)
+    output_bytes = os.path.getsize(output_pdf)
+    stages['pdf_output'] = stage_result(time.perf_counter() - start, 1, output_bytes)
+
+    merged_pdf = os.path.join(work_dir, "bench_merged.pdf")
+    start = time.perf_counter()
+    fh.merge_pdfs([output_pdf, output_pdf], merged_pdf)
+    stages['merge'] = stage_result(time.perf_counter() - start, 2, 2 * output_bytes)
+
+    # The whole pipeline as users run it
+    e2e_pdf = os.path.join(work_dir, "bench_e2e.pdf")
+    start = time.perf_counter()
+    fh.convert_folder_to_pdf(
+        corpus_dir, e2e_pdf, quality, pdf_options=pdf_options,
+        skip_converted=False, workers=workers
+    )
+    stages['end_to_end'] = stage_result(time.perf_counter() - start, len(files_info), total_bytes)
+
+    results['corpus'] = {'files': len(files_info), 'bytes': total_bytes}
+    results['output_bytes'] = os.path.getsize(e2e_pdf)
+    results['peak_rss_mb'] = get_peak_rss_mb()
+    return results
+
+def iter_stage_seconds(results):
+    """Yield (stage name, seconds) pairs, flattening per-format stages."""
+    for name, stage in results['stages'].items():
+        if 'seconds' in stage:
+            yield name, stage['seconds']
+        else:
+            for sub_name, sub_stage in stage.items():
+                yield f"{name}.{sub_name}", sub_stage['seconds']
+
+def compare_results(baseline, current, tolerance):
+    """Print per-stage time ratios; return the stages slower than tolerance.
+
+    Slowdowns under MIN_REGRESSION_SECONDS are not counted, whatever the
+    ratio.
+    """
+    baseline_seconds = dict(iter_stage_seconds(baseline))
+    regressions = []
+    print(f"{'stage':<20} {'baseline':>10} {'current':>10} {'ratio':>7}")
+    for name, seconds in iter_stage_seconds(current):
+        if name not in baseline_seconds:
+            continue
+        ratio = seconds / max(baseline_seconds[name], 1e-9)
+        flag = ""
+        if ratio > 1 + tolerance and seconds - baseline_seconds[name] >= MIN_REGRESSION_SECONDS:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<20} {baseline_seconds[name]:>10.4f} {seconds:>10.4f} {ratio:>7.2f}{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scan, decode, encode and PDF stages on a synthetic corpus."
+    )
+    parser.add_argument("-n", "--files", type=int, default=24, help="Number of synthetic images")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the corpus")
+    parser.add_argument("-q", "--quality", type=int, default=85, help="JPEG quality")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Worker processes")
+    parser.add_argument("--dpi", dest="target_dpi", type=int, default=None, help="Target DPI")
+    parser.add_argument(
+        "--repeats", type=int, default=3,
+        help="Timed runs; each stage reports its median (default: 3)"
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=1,
+        help="Untimed runs before the timed ones (default: 1)"
+    )
+    parser.add_argument("--heic-dir", help="Folder of HEIC samples to add (needs pyheif)")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", metavar="JSON", help="Earlier results to compare against")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.10,
+        help="Allowed slowdown per stage before --compare fails (default: 0.10)"
+    )
+    args = parser.parse_args(argv)
+    if args.repeats < 1 or args.warmup < 0:
+        parser.error("--repeats must be at least 1 and --warmup at least 0")
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    heic_dir = os.path.abspath(args.heic_dir) if args.heic_dir else None
+
+    # Run in a scratch dir so history, caches and logs stay out of the way
+    original_dir = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix="heic2pdf_bench_")
+    try:
+        os.chdir(work_dir)
+        corpus_dir = os.path.join(work_dir, "corpus")
+        generate_corpus(corpus_dir, args.files, args.seed)
+        if heic_dir:
+            try:
+                import pyheif  # noqa: F401
+                copy_heic_samples(heic_dir, corpus_dir)
+            except ImportError:
+                print("pyheif not installed; skipping HEIC samples", file=sys.stderr)
+
+        runs = [
+            run_benchmark(
+                corpus_dir, work_dir, args.quality, args.workers, args.target_dpi
+            )
+            for _ in range(args.warmup + args.repeats)
+        ]
+        results = median_results(runs[args.warmup:])
+    finally:
+        os.chdir(original_dir)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results.update({
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'settings': {
+            'files': args.files, 'seed': args.seed, 'quality': args.quality,
+            'workers': args.workers, 'target_dpi': args.target_dpi,
+            'repeats': args.repeats, 'warmup': args.warmup
+        }
+    })
+
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+    if compare_path:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+        if compare_results(baseline, results, args.tolerance):
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
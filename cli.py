@@ -0,0 +1,309 @@
+import sys
+import argparse
+from datetime import datetime
+
+from metrics import (
+    ConversionMetrics, JsonLinesSink, PrometheusTextSink, format_summary
+)
+from watcher import WATCH_DEBOUNCE, WATCH_SETTLE, watch_folder
+from fallback_handler import (
+    DECODE_MEMORY_BUDGET, HASH_ALGORITHM, PAGE_ENCODERS, PAGE_SIZES, SHARD_BY,
+    SUPPORTED_FORMATS, ConversionError, convert_folder_to_pdf, parse_color
+)
+
+def build_parser():
+    """Create the argument parser for the converter CLI."""
+    parser = argparse.ArgumentParser(
+        description="Convert HEIC, JPEG, PNG, BMP, GIF and TIFF images in a folder to PDF."
+    )
+    parser.add_argument("input_folder", help="Folder containing the images")
+    parser.add_argument("output_pdf", help="Path of the PDF to write")
+    parser.add_argument(
+        "-q", "--quality", type=int, default=85,
+        help="JPEG compression quality, 1-100 (default: 85)"
+    )
+
+    # File selection
+    parser.add_argument(
+        "--no-recursive", dest="recursive", action="store_false",
+        help="Do not scan subfolders"
+    )
+    parser.add_argument(
+        "--since", metavar="YYYY-MM-DD",
+        help="Only convert files modified on or after this date"
+    )
+    parser.add_argument(
+        "--no-skip-converted", dest="skip_converted", action="store_false",
+        help="Convert files again even if the history says they are done"
+    )
+    parser.add_argument(
+        "--append", action="store_true",
+        help="Add the new pages to the end of an existing output PDF"
+    )
+    parser.add_argument(
+        "--delete-source", action="store_true",
+        help="Delete source files after a successful conversion"
+    )
+    parser.add_argument(
+        "--abort-on-issues", action="store_true",
+        help="Stop when the pre-scan finds potential image issues"
+    )
+
+    # Performance
+    parser.add_argument(
+        "-j", "--workers", type=int, default=None,
+        help="Number of decode/encode worker processes (default: CPU count)"
+    )
+    parser.add_argument(
+        "--decode-memory", dest="decode_memory_mb", type=int,
+        default=DECODE_MEMORY_BUDGET // (1024 * 1024), metavar="MB",
+        help="Memory the workers may fill with decoded images at once; larger "
+             "images are decoded one at a time (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--hash", dest="hash_algorithm", default=HASH_ALGORITHM,
+        help=f"Hash algorithm for change detection (default: {HASH_ALGORITHM})"
+    )
+    parser.add_argument(
+        "--no-page-cache", dest="use_page_cache", action="store_false",
+        help="Decode and encode every page instead of reusing cached pages"
+    )
+
+    # Watch mode
+    parser.add_argument(
+        "--watch", action="store_true",
+        help="Keep running and append new images to the PDF as they arrive"
+    )
+    parser.add_argument(
+        "--debounce", type=float, default=WATCH_DEBOUNCE, metavar="SECONDS",
+        help=f"Quiet time before handling a burst of new files (default: {WATCH_DEBOUNCE})"
+    )
+    parser.add_argument(
+        "--settle", type=float, default=WATCH_SETTLE, metavar="SECONDS",
+        help=f"Time a file must stay unchanged before it is converted (default: {WATCH_SETTLE})"
+    )
+
+    # Metrics
+    parser.add_argument(
+        "--metrics-jsonl", metavar="PATH",
+        help="Append per-file and summary metrics as JSON lines to this file"
+    )
+    parser.add_argument(
+        "--metrics-prom", metavar="PATH",
+        help="Write run metrics in Prometheus text format to this file"
+    )
+
+    # Sharding
+    parser.add_argument(
+        "--shard-pages", type=int, metavar="N",
+        help="Split the output into name_001.pdf, name_002.pdf, ... of at most N pages"
+    )
+    parser.add_argument(
+        "--shard-mb", type=float, metavar="MB",
+        help="Split the output so each PDF holds at most this many MB of source images"
+    )
+    parser.add_argument(
+        "--shard-by", choices=list(SHARD_BY),
+        help="Start a new PDF for each subfolder or modification date"
+    )
+    parser.add_argument(
+        "--no-manifest", dest="write_manifest", action="store_false",
+        help="Do not write name_manifest.json when sharding"
+    )
+
+    # PDF options
+    parser.add_argument(
+        "--orientation", choices=["P", "L"], default="P",
+        help="Page orientation: P (portrait) or L (landscape)"
+    )
+    parser.add_argument(
+        "--page-size", choices=list(PAGE_SIZES), default="A4",
+        help="Page size (default: A4)"
+    )
+    parser.add_argument(
+        "--custom-size", nargs=2, type=int, metavar=("W", "H"),
+        help="Custom page size in mm, used with --page-size Custom"
+    )
+    parser.add_argument(
+        "--dpi", dest="target_dpi", type=int, default=None,
+        help="Downsample images to this resolution at their size on the page"
+    )
+    parser.add_argument(
+        "--encoder", choices=PAGE_ENCODERS, default="auto",
+        help="auto stores flat PNG, BMP, GIF and TIFF images losslessly (indexed, "
+             "gray or 1-bit) and photos as JPEG; jpeg encodes every page as "
+             "JPEG (default: auto)"
+    )
+    parser.add_argument(
+        "--max-size", dest="max_size_mb", type=float, metavar="MB",
+        help="Lower the JPEG quality of each page so the PDF stays under this size"
+    )
+    parser.add_argument(
+        "--max-page-size", dest="max_page_kb", type=float, metavar="KB",
+        help="Lower the JPEG quality of any page above this size"
+    )
+    parser.add_argument(
+        "--fit-downscale", action="store_true",
+        help="Also shrink pages that do not fit their size budget at the lowest quality"
+    )
+    parser.add_argument("--watermark", help="Watermark text")
+    parser.add_argument(
+        "--watermark-image", metavar="IMAGE",
+        help="Image (e.g. a translucent PNG) drawn over the center of every page"
+    )
+    parser.add_argument(
+        "--page-numbers", action="store_true", help="Add page numbers"
+    )
+    parser.add_argument(
+        "--split-long", dest="split_long_images", action="store_true",
+        help="Spread panoramas and long screenshots over several pages"
+    )
+    parser.add_argument(
+        "--merge", nargs="+", metavar="PDF", default=None,
+        help="PDF files to merge after the converted pages; with --append or "
+             "--watch only when the output PDF is first created"
+    )
+    parser.add_argument("--font", help="Font family for page text")
+    parser.add_argument(
+        "--background-color", metavar="R,G,B", help="Page background color"
+    )
+    return parser
+
+def print_progress(done, total, message, bytes_done):
+    """Print one progress line to stderr."""
+    print(f"[{done}/{total}] {message}" if total else message, file=sys.stderr)
+
+def print_issues(conversion_issues):
+    """List pre-scan issues on stderr."""
+    print("Potential issues detected:", file=sys.stderr)
+    for fname, issues in conversion_issues.items():
+        print(f"  {fname}: {', '.join(issues)}", file=sys.stderr)
+
+def print_watch_result(result):
+    """Report one watch mode conversion."""
+    if result['status'] == 'converted':
+        print(f"Added {result['pages']} pages to {result['output']}")
+        print(format_summary(result['metrics']))
+
+def watch(args, pdf_options, min_date, make_metrics, confirm_issues):
+    """Run watch mode until interrupted."""
+    print(f"Watching {args.input_folder} (Ctrl+C to stop)", file=sys.stderr)
+    try:
+        watch_folder(
+            args.input_folder, args.output_pdf, SUPPORTED_FORMATS,
+            recursive=args.recursive, debounce=args.debounce,
+            settle=args.settle, on_result=print_watch_result,
+            metrics_factory=make_metrics,
+            compression_quality=args.quality, pdf_options=pdf_options,
+            min_date=min_date, skip_converted=args.skip_converted,
+            delete_source=args.delete_source, workers=args.workers,
+            decode_budget=args.decode_memory_mb * 1024 * 1024,
+            hash_algorithm=args.hash_algorithm,
+            use_page_cache=args.use_page_cache,
+            progress_callback=print_progress, confirm_issues=confirm_issues
+        )
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+
+    min_date = None
+    if args.since:
+        try:
+            min_date = datetime.strptime(args.since, "%Y-%m-%d").timestamp()
+        except ValueError:
+            parser.error("Invalid date format for --since. Use YYYY-MM-DD")
+
+    try:
+        background_color = parse_color(args.background_color)
+    except ValueError as e:
+        parser.error(str(e))
+
+    sharded = args.shard_pages or args.shard_mb or args.shard_by
+    if sharded and args.append:
+        parser.error("--append cannot be combined with sharding")
+    if sharded and args.watch:
+        parser.error("--watch cannot be combined with sharding")
+    if sharded and args.split_long_images:
+        parser.error("--split-long cannot be combined with sharding")
+
+    if args.debounce < 0 or args.settle < 0:
+        parser.error("--debounce and --settle cannot be negative")
+
+    if args.page_size == "Custom" and not args.custom_size:
+        parser.error("--page-size Custom requires --custom-size W H")
+
+    pdf_options = {
+        'orientation': args.orientation,
+        'page_size': args.page_size,
+        'custom_size': tuple(args.custom_size) if args.custom_size else None,
+        'target_dpi': args.target_dpi,
+        'encoder': args.encoder,
+        'max_pdf_bytes': int(args.max_size_mb * 1024 * 1024) if args.max_size_mb else None,
+        'max_page_bytes': int(args.max_page_kb * 1024) if args.max_page_kb else None,
+        'fit_downscale': args.fit_downscale,
+        'watermark': args.watermark,
+        'watermark_image': args.watermark_image,
+        'page_numbers': args.page_numbers,
+        'split_long_images': args.split_long_images,
+        'merge_files': args.merge,
+        'font': args.font,
+        'background_color': background_color
+    }
+
+    def make_metrics():
+        sinks = []
+        if args.metrics_jsonl:
+            sinks.append(JsonLinesSink(args.metrics_jsonl))
+        if args.metrics_prom:
+            sinks.append(PrometheusTextSink(args.metrics_prom))
+        return ConversionMetrics(sinks)
+
+    def confirm_issues(conversion_issues):
+        print_issues(conversion_issues)
+        return not args.abort_on_issues
+
+    if args.watch:
+        return watch(args, pdf_options, min_date, make_metrics, confirm_issues)
+
+    try:
+        result = convert_folder_to_pdf(
+            args.input_folder, args.output_pdf, args.quality,
+            SUPPORTED_FORMATS, pdf_options=pdf_options,
+            recursive=args.recursive, min_date=min_date,
+            skip_converted=args.skip_converted,
+            delete_source=args.delete_source, workers=args.workers,
+            decode_budget=args.decode_memory_mb * 1024 * 1024,
+            hash_algorithm=args.hash_algorithm,
+            use_page_cache=args.use_page_cache, append=args.append,
+            shard_pages=args.shard_pages,
+            shard_bytes=int(args.shard_mb * 1024 * 1024) if args.shard_mb else None,
+            shard_by=args.shard_by, write_manifest=args.write_manifest,
+            metrics=make_metrics(),
+            progress_callback=print_progress, confirm_issues=confirm_issues
+        )
+    except ConversionError as e:
+        print(str(e), file=sys.stderr)
+        print(f"Error report: {e.report_path}", file=sys.stderr)
+        return 1
+
+    if result['status'] == 'no_files':
+        print("No matching files found.")
+    elif result['status'] == 'up_to_date':
+        print("All files are up to date.")
+    elif result['status'] == 'declined':
+        print("Conversion aborted because of potential issues.")
+        return 2
+    elif result.get('shards'):
+        print(f"{len(result['shards'])} PDFs created ({result['pages']} pages): {result['output']}")
+    else:
+        print(f"PDF created: {result['output']} ({result['pages']} pages)")
+    if result['status'] == 'converted':
+        print(format_summary(result['metrics']))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,39 @@
 import os
+import gc
 import json
+import math
 import time
 import hashlib
+import inspect
+import multiprocessing
 import logging
 from datetime import datetime
+import shutil
 import tempfile
+from io import BytesIO
 from functools import wraps
+from itertools import accumulate, repeat
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+)
 
-import requests
-from PIL import Image
+from PIL import Image, ImageOps
 from fpdf import FPDF
 
+from history_store import ConversionHistory
+from metrics import ConversionMetrics, RecordingMetrics, format_summary
+from strip_reader import open_rows, check_whole_decode
+
 # CloudConvert API key (replace with your actual key)
 CLOUDCONVERT_API_KEY = "your_cloudconvert_api_key"
+CLOUDCONVERT_API_URL = "https://api.cloudconvert.com/v2"
+# Files per CloudConvert job and concurrent uploads/downloads
+CLOUDCONVERT_BATCH_SIZE = 50
+CLOUDCONVERT_THREADS = 8
+# Request timeout and job polling backoff, in seconds
+CLOUDCONVERT_TIMEOUT = 60
+CLOUDCONVERT_POLL_INITIAL = 0.5
+CLOUDCONVERT_POLL_MAX = 10
 
 # Configure logging
 LOG_DIR = "logs"
@@ -26,8 +47,23 @@ logging.basicConfig(
 )
 
 # Add new global constants
-HISTORY_FILE = "conversion_history.json"
 CONVERSION_CACHE = ".conversion_cache"
+FINGERPRINT_INDEX = os.path.join(CONVERSION_CACHE, "fingerprints.json")
+# Encoded pages kept across runs, keyed by source hash and encode settings;
+# least recently used pages are evicted above the size cap
+PAGE_CACHE_DIR = os.path.join(CONVERSION_CACHE, "pages")
+PAGE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# JPEG and PNG pages are cached under their own extensions
+PAGE_CACHE_SUFFIXES = (".jpg", ".png")
+
+# Hashing settings; "blake2b" is faster than md5 on 64-bit machines, but
+# switching algorithms makes every file look new to the history
+HASH_ALGORITHM = "md5"
+HASH_CHUNK_SIZE = 1024 * 1024
+# Bytes kept from the start of each file to parse its image header
+HEADER_BYTES = 256 * 1024
+# Threads listing directories and hashing files during a scan
+SCAN_THREADS = 8
 
 # Add new constants for PDF settings
 PAGE_SIZES = {
@@ -37,43 +73,299 @@ PAGE_SIZES = {
     'Custom': None
 }
 
-def get_file_hash(filepath):
-    """Generate hash of file content for change detection."""
-    with open(filepath, "rb") as f:
-        return hashlib.md5(f.read()).hexdigest()
+# Encoded pages in flight above this many bytes are spilled to disk
+PAGE_MEMORY_BUDGET = 256 * 1024 * 1024
+# Pages are decoded in parallel only while their estimated decoded size
+# stays under this many bytes; bigger images are decoded alone
+DECODE_MEMORY_BUDGET = 2 * 1024 * 1024 * 1024
+# Bytes per pixel of decoded images by mode; other modes take 4 in Pillow
+DECODE_BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2}
+# Decoded bytes per file byte assumed when the header could not be read
+UNKNOWN_DECODE_RATIO = 10
+
+# "auto" picks a PDF filter per image; "jpeg" encodes every page as JPEG
+PAGE_ENCODERS = ("auto", "jpeg")
+# Images with at most this many colors can be embedded as indexed color
+PALETTE_MAX_COLORS = 256
+# Grayscale images count as flat (text, line art) when their most common
+# FLAT_TOP_LEVELS gray levels cover FLAT_COVERAGE of the pixels
+FLAT_TOP_LEVELS = 32
+FLAT_COVERAGE = 0.9
+
+# Lowest JPEG quality tried when fitting pages into a size budget
+FIT_MIN_QUALITY = 20
+# Pages are not shrunk below this many pixels on their shorter side
+FIT_MIN_SIDE = 256
+# Bytes set aside per page for the PDF structure around each image
+PDF_PAGE_OVERHEAD = 2048
+# Encoded page bytes fpdf may hold before its pages are copied into the
+# output file, so memory does not grow with the page count
+PDF_FLUSH_BYTES = 64 * 1024 * 1024
+
+# Ways to group files into separate PDFs when sharding
+SHARD_BY = ("folder", "date")
+
+# Image types picked up by the directory scan
+SUPPORTED_FORMATS = (".heic", ".jpeg", ".jpg", ".png", ".bmp", ".gif", ".tif", ".tiff")
+
+# EXIF (and TIFF) tag holding the camera orientation
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Transparent images are flattened onto the background color, or onto
+# this page color when there is none
+PAGE_COLOR = (255, 255, 255)
+# Rows of a 10 or 12-bit HEIC frame reduced to 8 bits per NumPy step
+HDR_STRIP_ROWS = 256
+
+# Images over this many pixels are decoded, resampled and embedded in
+# strips, each strip its own image on the page
+TILED_MIN_PIXELS = 64 * 1000 * 1000
+# Decoded bytes per strip in tiled mode, counting 4 bytes per pixel
+TILE_BYTES = 16 * 1024 * 1024
+# Reach of the LANCZOS filter, in output pixels on each side
+LANCZOS_SUPPORT = 3
 
-def load_conversion_history():
-    """Load conversion history from JSON file."""
+# Where the text watermark's baseline starts, in mm from the top left
+WATERMARK_ORIGIN = (80.7, 38.3)
+# Image watermarks are centered and scaled to this fraction of the page width
+WATERMARK_IMAGE_WIDTH = 0.5
+
+def load_fingerprint_index():
+    """Load the stat-keyed file fingerprint index."""
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r') as f:
+        if os.path.exists(FINGERPRINT_INDEX):
+            with open(FINGERPRINT_INDEX, 'r') as f:
                 return json.load(f)
     except Exception as e:
-        logging.error(f"Error loading conversion history: {e}")
+        logging.error(f"Error loading fingerprint index: {e}")
     return {}
 
-def save_conversion_history(history):
-    """Save conversion history to JSON file."""
+def save_fingerprint_index(index):
+    """Save the fingerprint index, replacing the old file atomically."""
     try:
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(history, f, indent=2)
+        os.makedirs(CONVERSION_CACHE, exist_ok=True)
+        temp_path = FINGERPRINT_INDEX + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(temp_path, FINGERPRINT_INDEX)
     except Exception as e:
-        logging.error(f"Error saving conversion history: {e}")
+        logging.error(f"Error saving fingerprint index: {e}")
+
+def get_image_metadata(img):
+    """Return the header metadata of an opened image as a JSON-friendly dict."""
+    orientation = 1
+    if 'exif' in img.info:
+        # Parse the EXIF block from the header; img.getexif() may decode
+        # the whole image for some formats
+        exif = Image.Exif()
+        exif.load(img.info['exif'])
+        orientation = exif.get(EXIF_ORIENTATION_TAG, 1)
+    elif img.format == 'TIFF':
+        orientation = img.tag_v2.get(EXIF_ORIENTATION_TAG, 1)
+    return {
+        'format': img.format,
+        'mode': img.mode,
+        'width': img.size[0],
+        'height': img.size[1],
+        'orientation': orientation,
+        'progressive': bool(img.info.get('progressive') or img.info.get('progression')),
+        'transparent': img.mode in ("RGBA", "LA", "PA") or 'transparency' in img.info
+    }
+
+def read_header_metadata(file_path, head):
+    """Parse image metadata from the first bytes of a file, or None."""
+    if file_path.lower().endswith(".heic"):
+        try:
+            import pyheif
+            heif_file = pyheif.open(file_path)
+            return {
+                'format': 'HEIF', 'mode': heif_file.mode,
+                'width': heif_file.size[0], 'height': heif_file.size[1],
+                'orientation': 1, 'progressive': False,
+                'transparent': heif_file.mode == "RGBA"
+            }
+        except Exception:
+            return None
+
+    try:
+        with Image.open(BytesIO(head)) as img:
+            return get_image_metadata(img)
+    except Exception:
+        pass
+    # The header did not fit in HEADER_BYTES (e.g. a huge EXIF block)
+    try:
+        with Image.open(file_path) as img:
+            return get_image_metadata(img)
+    except Exception as e:
+        logging.warning(f"Could not read image header of {file_path}: {e}")
+        return None
+
+def fingerprint_file(file_path, algorithm=HASH_ALGORITHM):
+    """Hash a file and parse its image header in a single read.
 
-def scan_directory(directory, supported_formats, min_date=None):
-    """Recursively scan directory for supported files."""
+    Returns (hash, metadata); metadata is None if the header is unreadable.
+    """
+    hasher = hashlib.new(algorithm)
+    with open(file_path, "rb") as f:
+        head = f.read(HEADER_BYTES)
+        hasher.update(head)
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest(), read_header_metadata(file_path, head)
+
+def get_cached_fingerprint(index, key, stamp, algorithm=HASH_ALGORITHM):
+    """Return the index entry for key if its stat stamp still matches, else None.
+
+    stamp is [size, mtime_ns, inode]; any change means the file is re-read.
+    """
+    entry = index.get(key)
+    if (entry and entry['stat'] == stamp and entry['algorithm'] == algorithm
+            and 'meta' in entry):
+        return entry
+    return None
+
+def list_directory(directory, supported_formats):
+    """List one directory; returns ([(path, stat), ...] for supported files, subdirs)."""
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(supported_formats) and entry.is_file():
+                    # DirEntry caches the stat result (free on Windows)
+                    files.append((entry.path, entry.stat()))
+    except OSError as e:
+        logging.warning(f"Could not scan {directory}: {e}")
+    return files, subdirs
+
+def walk_directory(directory, supported_formats, recursive=True, threads=SCAN_THREADS):
+    """Find supported files, listing subdirectories concurrently.
+
+    Returns ([(path, stat), ...] sorted by path, scanned_dirs). The thread
+    pool hides per-directory latency on network filesystems.
+    """
+    found = []
+    scanned_dirs = set()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(list_directory, directory, supported_formats): directory}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                scanned_dirs.add(os.path.abspath(pending.pop(future)))
+                files, subdirs = future.result()
+                found.extend(files)
+                if recursive:
+                    for subdir in subdirs:
+                        pending[executor.submit(list_directory, subdir, supported_formats)] = subdir
+    # Listings arrive in completion order; sort for the same result every run
+    found.sort(key=lambda item: item[0])
+    return found, scanned_dirs
+
+def scan_directory(directory, supported_formats, min_date=None,
+                   hash_algorithm=HASH_ALGORITHM, recursive=True, threads=SCAN_THREADS,
+                   metrics=None):
+    """Scan directory (and subfolders if recursive) for supported files.
+
+    Each file's hash and image header metadata come from one read and are
+    cached in the fingerprint index for the next scan; only new or
+    changed files are read, using the same thread pool size. The walk and
+    the hashing are timed as the "scan" and "hash" stages of metrics.
+    """
+    metrics = metrics or ConversionMetrics()
+    scan_start = time.perf_counter()
+    found, scanned_dirs = walk_directory(directory, supported_formats, recursive, threads)
+    return fingerprint_files(
+        found, min_date, hash_algorithm, threads, metrics, scanned_dirs, scan_start
+    )
+
+def scan_files(file_paths, supported_formats, min_date=None,
+               hash_algorithm=HASH_ALGORITHM, threads=SCAN_THREADS, metrics=None):
+    """Like scan_directory(), for a known list of files instead of a walk.
+
+    Missing files and unsupported types are skipped.
+    """
+    metrics = metrics or ConversionMetrics()
+    scan_start = time.perf_counter()
+    found = []
+    for file_path in file_paths:
+        if not file_path.lower().endswith(supported_formats):
+            continue
+        try:
+            found.append((file_path, os.stat(file_path)))
+        except FileNotFoundError:
+            continue
+    return fingerprint_files(
+        found, min_date, hash_algorithm, threads, metrics, scan_start=scan_start
+    )
+
+def fingerprint_files(found, min_date, hash_algorithm, threads, metrics,
+                      scanned_dirs=(), scan_start=None):
+    """Build files_info for (path, stat) pairs using the fingerprint index.
+
+    Index entries for files that disappeared from scanned_dirs are dropped.
+    """
+    index = load_fingerprint_index()
+    index_size = len(index)
+
+    seen = set()
     files_info = []
-    for root, _, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(supported_formats):
-                file_path = os.path.join(root, file)
-                mod_time = os.path.getmtime(file_path)
-                if min_date is None or mod_time >= min_date:
-                    files_info.append({
-                        'path': file_path,
-                        'modified': mod_time,
-                        'hash': get_file_hash(file_path)
-                    })
+    to_read = []
+    for file_path, stat_result in found:
+        key = os.path.abspath(file_path)
+        seen.add(key)
+        # Prune by date before touching the file contents
+        if min_date is not None and stat_result.st_mtime < min_date:
+            continue
+        stamp = [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino]
+        entry = get_cached_fingerprint(index, key, stamp, hash_algorithm)
+        file_info = {
+            'path': file_path,
+            'modified': stat_result.st_mtime,
+            'size': stat_result.st_size,
+            'hash': entry['hash'] if entry else None,
+            'meta': entry['meta'] if entry else None
+        }
+        if entry is None:
+            to_read.append((file_info, key, stamp))
+        files_info.append(file_info)
+
+    if scan_start is not None:
+        metrics.add('scan', time.perf_counter() - scan_start, len(found))
+
+    # Hash new and changed files; hashlib and file reads release the GIL
+    if to_read:
+        hash_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            fingerprints = executor.map(
+                fingerprint_file,
+                [file_info['path'] for file_info, _, _ in to_read],
+                repeat(hash_algorithm)
+            )
+            for (file_info, key, stamp), (file_hash, meta) in zip(to_read, fingerprints):
+                file_info['hash'] = file_hash
+                file_info['meta'] = meta
+                index[key] = {
+                    'stat': stamp, 'algorithm': hash_algorithm,
+                    'hash': file_hash, 'meta': meta
+                }
+        metrics.add(
+            'hash', time.perf_counter() - hash_start, len(to_read),
+            sum(file_info['size'] for file_info, _, _ in to_read)
+        )
+
+    # Forget files that disappeared from the scanned directories
+    stale = [
+        key for key in index
+        if os.path.dirname(key) in scanned_dirs and key not in seen
+    ]
+    for key in stale:
+        del index[key]
+
+    if to_read or stale or len(index) != index_size:
+        save_fingerprint_index(index)
+    logging.info(f"Scanned {len(files_info)} files in {len(scanned_dirs)} folders, hashed {len(to_read)}")
     return files_info
 
 def retry_on_failure(max_retries=3, delay=1):
@@ -98,278 +390,1643 @@ def retry_on_failure(max_retries=3, delay=1):
         return wrapper
     return decorator
 
-@retry_on_failure(max_retries=3)
-def convert_heic_to_jpeg_with_cloudconvert(input_path, output_path):
-    """Convert a HEIC file to JPEG using CloudConvert API with retry."""
-    logging.info(f"Starting CloudConvert conversion for {input_path}")
-    try:
-        url = "https://api.cloudconvert.com/v2/jobs"
-        headers = {
-            "Authorization": f"Bearer {CLOUDCONVERT_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        data = {
-            "tasks": {
-                "import-my-file": {"operation": "import/upload"},
-                "convert-my-file": {
-                    "operation": "convert",
-                    "input": "import-my-file",
-                    "output_format": "jpg"
-                },
-                "export-my-file": {
-                    "operation": "export/url",
-                    "input": "convert-my-file"
-                }
-            }
-        }
+class CloudConvertClient:
+    """CloudConvert client converting many HEIC files per job.
+
+    One pooled HTTP session is shared by all requests; uploads and
+    downloads run concurrently and downloads are streamed to disk.
+    """
+    def __init__(self, api_key=None, api_url=None, threads=CLOUDCONVERT_THREADS):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # Resolved at call time so the module settings can point elsewhere,
+        # e.g. at a local stand-in server
+        api_key = api_key or CLOUDCONVERT_API_KEY
+        self.api_url = (api_url or CLOUDCONVERT_API_URL).rstrip("/")
+        self.threads = threads
+        # Only API calls carry the key; upload and download URLs are signed
+        self.api_headers = {"Authorization": f"Bearer {api_key}"}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=threads, pool_maxsize=threads)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
 
-        # Create a conversion job
-        response = requests.post(url, json=data, headers=headers)
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def tasks_by_name(job):
+        """Return the job's tasks keyed by name (the API returns a list)."""
+        tasks = job["data"]["tasks"]
+        if isinstance(tasks, dict):
+            return tasks
+        return {task["name"]: task for task in tasks}
+
+    def create_job(self, count):
+        """Create one job with an import/convert/export chain per file."""
+        tasks = {}
+        for i in range(count):
+            tasks[f"import-{i}"] = {"operation": "import/upload"}
+            tasks[f"convert-{i}"] = {
+                "operation": "convert",
+                "input": f"import-{i}",
+                "output_format": "jpg"
+            }
+            tasks[f"export-{i}"] = {
+                "operation": "export/url",
+                "input": f"convert-{i}"
+            }
+        response = self.session.post(
+            f"{self.api_url}/jobs", json={"tasks": tasks},
+            headers=self.api_headers, timeout=CLOUDCONVERT_TIMEOUT
+        )
         response.raise_for_status()
-        job = response.json()
+        return response.json()
 
-        # Upload the HEIC file
-        upload_url = job["data"]["tasks"]["import-my-file"]["result"]["form"]["url"]
+    def upload(self, import_task, input_path):
+        """Upload one file to an import/upload task."""
+        form = import_task["result"]["form"]
         with open(input_path, "rb") as file:
-            upload_response = requests.post(upload_url, files={"file": file})
-        upload_response.raise_for_status()
+            response = self.session.post(
+                form["url"], data=form.get("parameters", {}),
+                files={"file": file}, timeout=CLOUDCONVERT_TIMEOUT
+            )
+        response.raise_for_status()
 
-        # Wait for conversion and download the result
-        job_id = job["data"]["id"]
-        result_url = f"https://api.cloudconvert.com/v2/jobs/{job_id}"
+    def wait_for_job(self, job_id):
+        """Poll the job with exponential backoff until it finishes."""
+        delay = CLOUDCONVERT_POLL_INITIAL
         while True:
-            result_response = requests.get(result_url, headers=headers)
-            result_response.raise_for_status()
-            result_data = result_response.json()
-            status = result_data["data"]["status"]
+            response = self.session.get(
+                f"{self.api_url}/jobs/{job_id}",
+                headers=self.api_headers, timeout=CLOUDCONVERT_TIMEOUT
+            )
+            response.raise_for_status()
+            job = response.json()
+            status = job["data"]["status"]
             if status == "finished":
-                files = result_data["data"]["tasks"]["export-my-file"]["result"]["files"]
-                download_url = files[0]["url"]
-                download_response = requests.get(download_url)
-                with open(output_path, "wb") as f:
-                    f.write(download_response.content)
-                break
-            elif status in {"error", "failed"}:
+                return job
+            if status in {"error", "failed"}:
                 raise RuntimeError("CloudConvert job failed.")
-            time.sleep(2)
+            time.sleep(delay)
+            delay = min(delay * 2, CLOUDCONVERT_POLL_MAX)
+
+    def download(self, export_task, output_path):
+        """Stream the first exported file of a task to output_path."""
+        url = export_task["result"]["files"][0]["url"]
+        with self.session.get(url, stream=True, timeout=CLOUDCONVERT_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(output_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=HASH_CHUNK_SIZE):
+                    f.write(chunk)
+
+    def convert(self, conversions):
+        """Convert [(input_path, output_path), ...] to JPEG in one job."""
+        job = self.create_job(len(conversions))
+        tasks = self.tasks_by_name(job)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            list(executor.map(
+                lambda i: self.upload(tasks[f"import-{i}"], conversions[i][0]),
+                range(len(conversions))
+            ))
+
+            tasks = self.tasks_by_name(self.wait_for_job(job["data"]["id"]))
+            list(executor.map(
+                lambda i: self.download(tasks[f"export-{i}"], conversions[i][1]),
+                range(len(conversions))
+            ))
+
+@retry_on_failure(max_retries=3)
+def convert_batch_with_cloudconvert(conversions):
+    """Convert one batch of (input_path, output_path) pairs with retry."""
+    logging.info(f"Starting CloudConvert job for {len(conversions)} files")
+    try:
+        with CloudConvertClient() as client:
+            client.convert(conversions)
     except Exception as e:
         raise RuntimeError(f"CloudConvert API error: {e}")
 
+def convert_heic_batch_with_cloudconvert(input_paths, output_dir):
+    """Convert HEIC files to JPEGs in output_dir using batched jobs.
+
+    Returns {input_path: jpeg_path}.
+    """
+    converted = {}
+    for start in range(0, len(input_paths), CLOUDCONVERT_BATCH_SIZE):
+        conversions = []
+        for input_path in input_paths[start:start + CLOUDCONVERT_BATCH_SIZE]:
+            fd, output_path = tempfile.mkstemp(dir=output_dir, suffix=".jpg")
+            os.close(fd)
+            conversions.append((input_path, output_path))
+        convert_batch_with_cloudconvert(conversions)
+        converted.update(conversions)
+    return converted
+
+def convert_heic_to_jpeg_with_cloudconvert(input_path, output_path):
+    """Convert a HEIC file to JPEG using CloudConvert API with retry."""
+    convert_batch_with_cloudconvert([(input_path, output_path)])
+
+def pyheif_available():
+    """Check whether HEIC files can be decoded locally."""
+    try:
+        import pyheif  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def check_metadata_issues(meta, file_size):
+    """Check for potential issues using header metadata from the scan."""
+    issues = []
+    size = (meta['width'], meta['height'])
+    # Check resolution
+    if any(dim > 5000 for dim in size):
+        issues.append("High resolution might cause memory issues")
+    elif any(dim < 100 for dim in size):
+        issues.append("Low resolution might affect quality")
+
+    # Check color mode
+    if meta['mode'] not in ['RGB', 'RGBA']:
+        issues.append(f"Unusual color mode: {meta['mode']}")
+
+    # Check file size
+    file_size = file_size / (1024 * 1024)  # MB
+    if file_size > 10:
+        issues.append(f"Large file size: {file_size:.1f}MB")
+    return issues
+
 def check_image_issues(image_path):
     """Check for potential issues in the image."""
-    issues = []
     try:
         with Image.open(image_path) as img:
-            # Check resolution
-            if any(dim > 5000 for dim in img.size):
-                issues.append("High resolution might cause memory issues")
-            elif any(dim < 100 for dim in img.size):
-                issues.append("Low resolution might affect quality")
-            
-            # Check color mode
-            if img.mode not in ['RGB', 'RGBA']:
-                issues.append(f"Unusual color mode: {img.mode}")
-            
-            # Check file size
-            file_size = os.path.getsize(image_path) / (1024 * 1024)  # MB
-            if file_size > 10:
-                issues.append(f"Large file size: {file_size:.1f}MB")
+            meta = get_image_metadata(img)
+        return check_metadata_issues(meta, os.path.getsize(image_path))
     except Exception as e:
-        issues.append(f"Error analyzing image: {str(e)}")
-    return issues
+        return [f"Error analyzing image: {str(e)}"]
+
+def can_pass_through_jpeg(meta):
+    """Check from header metadata whether a JPEG can be embedded as-is.
+
+    Baseline RGB or grayscale JPEGs without an EXIF rotation can have
+    their DCT stream copied straight into the PDF.
+    """
+    return (
+        meta['format'] == 'JPEG' and meta['mode'] in ('RGB', 'L')
+        and not meta['progressive'] and meta['orientation'] == 1
+    )
+
+def get_passthrough_page(file_info, max_pixels, max_bytes=None, split_box=None):
+    """Return a ready page for a scanned file that needs no worker, or None."""
+    meta = file_info.get('meta')
+    if not meta or not can_pass_through_jpeg(meta):
+        return None
+    if max_bytes and file_info['size'] > max_bytes:
+        return None
+    img_size = (meta['width'], meta['height'])
+    if split_box and len(get_split_pieces(img_size, split_box)) > 1:
+        return None
+    if get_downsample_size(img_size, max_pixels):
+        return None
+    return file_info['path'], img_size, False
+
+def get_downsample_size(img_size, max_pixels):
+    """Return the size that fits img_size into max_pixels, or None if it already fits."""
+    if not max_pixels:
+        return None
+    img_w, img_h = img_size
+    ratio = min(max_pixels[0] / img_w, max_pixels[1] / img_h)
+    if ratio >= 1:
+        return None
+    return max(1, round(img_w * ratio)), max(1, round(img_h * ratio))
 
 class CustomPDF(FPDF):
-    """Extended FPDF class with watermark and page numbers."""
+    """Extended FPDF class with watermark and page numbers.
+
+    The background color and text watermark are drawn under every page
+    and an image watermark over it. With shared_layers they are left out,
+    for a PdfStreamWriter to draw from the forms of render_page_layers().
+    """
     def __init__(
         self, orientation='P', unit='mm', format='A4',
-        watermark_text=None, font=None, background_color=None
+        watermark_text=None, font=None, background_color=None,
+        watermark_image=None, shared_layers=False
     ):
         super().__init__(orientation=orientation, unit=unit, format=format)
         self.watermark_text = watermark_text
         self.font = font
         self.background_color = background_color
+        self.watermark_image = watermark_image
+        self.shared_layers = shared_layers
+        # Pages already in the PDF these pages get appended to
+        self.page_number_offset = 0
+        if watermark_image:
+            with Image.open(watermark_image) as img:
+                self.watermark_aspect = img.height / img.width
 
     def header(self):
+        if self.shared_layers:
+            return
+        # Under the page content, the fill first so it cannot hide the text
+        if self.background_color:
+            self.set_fill_color(*self.background_color)
+            self.rect(0, 0, self.w, self.h, 'F')
         if self.watermark_text:
-            self.set_font('Arial', 'I', 30)
-            self.set_text_color(200, 200, 200)  # Light gray
-            self.rotate(45)
-            self.text(40, 80, self.watermark_text)
-            self.rotate(0)
+            # 30pt light gray text rising at 45 degrees from its baseline start
+            self.set_font('Helvetica', 'I', 30)
+            self.set_text_color(200, 200, 200)
+            with self.rotation(45, *WATERMARK_ORIGIN):
+                self.text(*WATERMARK_ORIGIN, self.watermark_text)
 
     def footer(self):
+        if self.watermark_image and not self.shared_layers:
+            # Over the page content; use a translucent PNG to keep it subtle
+            w = self.w * WATERMARK_IMAGE_WIDTH
+            h = w * self.watermark_aspect
+            self.image(self.watermark_image, (self.w - w) / 2, (self.h - h) / 2, w, h)
         if self.page_numbers:
             self.set_y(-15)
             self.set_font('Arial', 'I', 8)
             self.set_text_color(128)
-            self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
+            self.cell(0, 10, f'Page {self.page_no() + self.page_number_offset}', 0, 0, 'C')
 
     def add_page(self, orientation='', size='', rotation=0):
         super().add_page(orientation, size, rotation)
-        if self.background_color:
-            self.set_fill_color(*self.background_color)
-            self.rect(0, 0, self.w, self.h, 'F')
         if self.font:
             self.set_font(self.font)
 
+def classify_image(image):
+    """Classify an RGB or L image as "photo", "gray", "palette" or "bilevel".
+
+    Returns (kind, colors) where colors is the getcolors() histogram, or
+    None for photos. getcolors() gives up as soon as it has seen more than
+    PALETTE_MAX_COLORS colors, so photos are rejected cheaply.
+    """
+    colors = image.getcolors(PALETTE_MAX_COLORS)
+    if colors is None:
+        return "photo", None
+    if image.mode == "L":
+        levels = {color for _, color in colors}
+    elif all(r == g == b for _, (r, g, b) in colors):
+        levels = {r for _, (r, _, _) in colors}
+    else:
+        return "palette", colors
+    if levels <= {0, 255}:
+        return "bilevel", colors
+    return "gray", colors
+
+def is_flat(colors, pixels):
+    """Check whether a few colors of a histogram cover most of the pixels."""
+    counts = sorted((count for count, _ in colors), reverse=True)
+    return sum(counts[:FLAT_TOP_LEVELS]) >= FLAT_COVERAGE * pixels
+
+def to_palette(image, colors):
+    """Return an RGB image with at most 256 colors as an exact P image."""
+    palette = Image.new("P", (1, 1))
+    palette.putpalette([value for _, rgb in colors for value in rgb])
+    return image.quantize(palette=palette, dither=Image.Dither.NONE)
+
+def select_page_encoding(image):
+    """Pick how to store an RGB or L page image.
+
+    Returns (image, format). Flat content is stored losslessly as PNG,
+    which fpdf embeds with Flate: 1-bit for black and white, indexed color
+    for up to 256 colors and 8-bit gray for text-like grayscale. Photos
+    stay JPEG (DCT), grayscale ones with a single channel.
+    """
+    kind, colors = classify_image(image)
+    if kind == "bilevel":
+        return image.convert("L").convert("1", dither=Image.Dither.NONE), "PNG"
+    if kind == "palette":
+        return to_palette(image, colors), "PNG"
+    if kind == "gray":
+        image = image.convert("L")
+        if is_flat(colors, image.width * image.height):
+            return image, "PNG"
+    return image, "JPEG"
+
+def get_page_codec(page_image):
+    """Return the PDF encoding of an encoded page (bytes or path).
+
+    One of "dct" (JPEG), "bilevel", "indexed" or "flate", read from the
+    JPEG or PNG header.
+    """
+    if isinstance(page_image, bytes):
+        head = page_image[:26]
+    else:
+        with open(page_image, 'rb') as f:
+            head = f.read(26)
+    if not head.startswith(b"\x89PNG"):
+        return "dct"
+    # IHDR holds the bit depth and color type at bytes 24 and 25
+    bit_depth, color_type = head[24], head[25]
+    if color_type == 3:
+        return "indexed"
+    if color_type == 0 and bit_depth == 1:
+        return "bilevel"
+    return "flate"
+
+def get_icc_profile(image):
+    """Return the ICC profile of image if it fits the image's color space."""
+    profile = image.info.get('icc_profile')
+    if not profile:
+        return None
+    # Bytes 16-20 of the profile header name the color space it describes
+    space = profile[16:20]
+    if (image.mode in ("RGB", "RGBX") and space == b"RGB ") or (
+        image.mode == "L" and space == b"GRAY"
+    ):
+        return profile
+    return None
+
+def save_image_bytes(image, image_format, **params):
+    """Return image saved in image_format as bytes, keeping its ICC profile."""
+    buffer = BytesIO()
+    profile = get_icc_profile(image)
+    if profile:
+        params['icc_profile'] = profile
+    image.save(buffer, image_format, **params)
+    return buffer.getvalue()
+
+def flatten_alpha(image, background_color=None):
+    """Composite a transparent image onto the page color, as RGB."""
+    if image.mode != "RGBA":
+        image = image.convert("RGBA")
+    flat = Image.new("RGB", image.size, background_color or PAGE_COLOR)
+    # The RGBA image doubles as its own mask
+    flat.paste(image, (0, 0), image)
+    if 'icc_profile' in image.info:
+        flat.info['icc_profile'] = image.info['icc_profile']
+    return flat
+
+def to_page_mode(image, encoder="auto", background_color=None):
+    """Flatten transparency and convert image to RGB.
+
+    Grayscale stays L when the encoder can store it as such.
+    """
+    if image.mode in ("RGBA", "LA", "PA") or 'transparency' in image.info:
+        image = flatten_alpha(image, background_color)
+    if image.mode != "RGB" and not (image.mode == "L" and encoder == "auto"):
+        image = image.convert("RGB")
+    return image
+
+def reduce_hdr_frame(numpy, heif_file, background_color=None):
+    """Reduce a 10 or 12-bit pyheif frame to an 8-bit RGBX image.
+
+    The decoder's 16-bit buffer is read in place, and scaling and alpha
+    compositing are done together, a strip of rows at a time, straight
+    into the buffer the returned image is mapped on. That buffer is the
+    only full-frame allocation.
+    """
+    width, height = heif_file.size
+    channels = 4 if heif_file.mode == "RGBA" else 3
+    max_value = (1 << heif_file.bit_depth) - 1
+    frame = numpy.frombuffer(heif_file.data, dtype="<u2")
+    frame = frame.reshape(height, heif_file.stride // 2)[:, :width * channels]
+    frame = frame.reshape(height, width, channels)
+
+    pixels = numpy.empty((height, width, 4), numpy.uint8)
+    pixels[..., 3] = 255
+    background = numpy.array(background_color or PAGE_COLOR, numpy.float32)
+    scale = numpy.float32(255 / max_value)
+    for top in range(0, height, HDR_STRIP_ROWS):
+        strip = frame[top:top + HDR_STRIP_ROWS]
+        rgb = strip[..., :3] * scale
+        if channels == 4:
+            alpha = strip[..., 3:] * numpy.float32(1 / max_value)
+            rgb -= background
+            rgb *= alpha
+            rgb += background
+        rgb += 0.5
+        pixels[top:top + HDR_STRIP_ROWS, :, :3] = rgb
+    return Image.frombuffer("RGBX", (width, height), pixels, "raw", "RGBX", 0, 1)
+
+def decode_heic(file_path, background_color=None):
+    """Decode a HEIC file with pyheif into an RGB or RGBX image.
+
+    8-bit frames are wrapped with Image.frombuffer() rather than copied
+    before use, and transparent ones are composited onto the page color
+    by Pillow. 10 and 12-bit frames go through reduce_hdr_frame() when
+    NumPy is installed; without it, libheif reduces them to 8 bits. The
+    embedded ICC profile is kept in image.info.
+    """
+    import pyheif
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    heif_file = pyheif.read(file_path, convert_hdr_to_8bit=numpy is None)
+    if heif_file.bit_depth > 8:
+        image = reduce_hdr_frame(numpy, heif_file, background_color)
+    else:
+        image = Image.frombuffer(
+            heif_file.mode, heif_file.size, heif_file.data,
+            "raw", heif_file.mode, heif_file.stride, 1
+        )
+        if heif_file.mode == "RGBA":
+            # The composite owns its pixels; the view dies with heif_file
+            image = flatten_alpha(image, background_color)
+    profile = heif_file.color_profile
+    if profile and profile['type'] in ("prof", "rICC"):
+        image.info['icc_profile'] = profile['data']
+    return image
+
+def fit_jpeg(image, compression_quality, max_bytes, downscale=False):
+    """Encode image as the highest quality JPEG of at most max_bytes.
+
+    Qualities from FIT_MIN_QUALITY up to compression_quality are binary
+    searched on the decoded image, so it is only decoded once. If even the
+    lowest quality is too large and downscale is set, the image is shrunk
+    by the estimated excess and searched again. Returns (data, image);
+    when nothing fits, data is the smallest encoding found.
+    """
+    while True:
+        data = save_image_bytes(image, "JPEG", quality=compression_quality)
+        if len(data) <= max_bytes:
+            return data, image
+        low, high = FIT_MIN_QUALITY, compression_quality - 1
+        best = None
+        smallest = data
+        while low <= high:
+            quality = (low + high) // 2
+            trial = save_image_bytes(image, "JPEG", quality=quality)
+            if len(trial) <= max_bytes:
+                best = trial
+                low = quality + 1
+            else:
+                smallest = min(smallest, trial, key=len)
+                high = quality - 1
+        if best:
+            return best, image
+        if not downscale or min(image.size) <= FIT_MIN_SIDE:
+            return smallest, image
+        # JPEG size grows roughly with the pixel count; one scale for both
+        # sides keeps the aspect ratio, and the shorter side stops at
+        # FIT_MIN_SIDE
+        scale = max(0.5, min(0.9, (max_bytes / len(smallest)) ** 0.5))
+        scale = max(scale, FIT_MIN_SIDE / min(image.size))
+        size = tuple(max(1, round(side * scale)) for side in image.size)
+        image = image.resize(size, Image.LANCZOS, reducing_gap=3.0)
+
+def encode_page(image, compression_quality, spill_dir=None, spill_threshold=None,
+                encoder="auto", max_bytes=None, downscale=False):
+    """Encode a page image as JPEG or PNG bytes.
+
+    With the "auto" encoder, select_page_encoding() decides between the
+    two; "jpeg" always gives JPEG. With max_bytes, lossless pages over the
+    budget fall back to JPEG and fit_jpeg() picks the quality (and, with
+    downscale, the size). Returns (page_image, img_size); pages larger
+    than spill_threshold are written to spill_dir and their path is
+    returned instead of the bytes.
+    """
+    data = None
+    image_format = "JPEG"
+    source = image
+    if encoder == "auto":
+        image, image_format = select_page_encoding(image)
+        if image_format == "PNG":
+            data = save_image_bytes(image, "PNG")
+            if max_bytes and len(data) > max_bytes:
+                data, image, image_format = None, source, "JPEG"
+    if image_format == "JPEG":
+        if max_bytes:
+            data, image = fit_jpeg(image, compression_quality, max_bytes, downscale)
+        else:
+            data = save_image_bytes(image, "JPEG", quality=compression_quality)
+    if spill_dir and spill_threshold and len(data) > spill_threshold:
+        suffix = ".jpg" if image_format == "JPEG" else ".png"
+        fd, spill_path = tempfile.mkstemp(dir=spill_dir, suffix=suffix)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return spill_path, image.size
+    return data, image.size
+
+def to_page_image(image, target_size=None, encoder="auto", background_color=None):
+    """Turn an opened image upright, into page mode and to target_size."""
+    check_whole_decode(image)
+    image = ImageOps.exif_transpose(image)
+    image = to_page_mode(image, encoder, background_color)
+    if target_size:
+        image = image.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+    return image
+
+def decode_page_image(file_path, max_pixels=None, encoder="auto", background_color=None):
+    """Decode a source file into the image prepare_page() would encode.
+
+    Follows the whole-image path of prepare_page() (HEIC with pyheif);
+    the benchmark uses it to time decoding on its own. Returns (image,
+    encoder), the encoder being "jpeg" for JPEG and HEIC sources.
+    """
+    if file_path.lower().endswith(".heic"):
+        image = decode_heic(file_path, background_color)
+        target_size = get_downsample_size(image.size, max_pixels)
+        if target_size:
+            image = image.resize(target_size, Image.LANCZOS, reducing_gap=3.0)
+        return image, "jpeg"
+
+    with Image.open(file_path) as image:
+        meta = get_image_metadata(image)
+        rotated = meta['orientation'] in (5, 6, 7, 8)
+        target_size = get_downsample_size(
+            image.size[::-1] if rotated else image.size, max_pixels
+        )
+        if image.format == 'JPEG':
+            encoder = "jpeg"
+            if target_size:
+                image.draft('RGB', target_size[::-1] if rotated else target_size)
+        image = to_page_image(image, target_size, encoder, background_color)
+        image.load()
+    return image, encoder
+
+def prepare_page(file_path, compression_quality, max_pixels=None,
+                 spill_dir=None, spill_threshold=None, encoder="auto",
+                 max_bytes=None, downscale=False, background_color=None,
+                 split_box=None):
+    """Decode and encode one source file into an image ready for the PDF.
+
+    Runs in a worker process. max_pixels is the image box in pixels,
+    max_bytes and downscale the size budget, split_box the image box for
+    splitting long images. Returns (page_image, img_size,
+    used_cloudconvert, timings); page_image is bytes, a path, or a list of
+    pieces for tiled images.
+    """
+    used_cloudconvert = False
+    timings = {}
+    start = time.perf_counter()
+
+    # Handle HEIC files
+    if file_path.lower().endswith(".heic"):
+        if not pyheif_available():
+            # Fallback to CloudConvert, then treat its JPEG like any other
+            logging.info(f"Falling back to CloudConvert for {file_path}")
+            fd, download_path = tempfile.mkstemp(dir=spill_dir, suffix=".jpg")
+            os.close(fd)
+            convert_heic_to_jpeg_with_cloudconvert(file_path, download_path)
+            file_path = download_path
+            used_cloudconvert = True
+            timings['cloudconvert'] = time.perf_counter() - start
+            start = time.perf_counter()
+        else:
+            # Attempt to convert HEIC locally
+            image, _ = decode_page_image(file_path, max_pixels, "jpeg", background_color)
+            timings['decode'] = time.perf_counter() - start
+            start = time.perf_counter()
+            page_image, img_size = encode_page(
+                image, compression_quality, spill_dir, spill_threshold, "jpeg",
+                max_bytes, downscale
+            )
+            timings['encode'] = time.perf_counter() - start
+            image.close()
+            return page_image, img_size, False, timings
+
+    # Handle JPEG, PNG, BMP, GIF and TIFF directly
+    with open_page_source(file_path, split_box) as image:
+        meta = get_image_metadata(image)
+        # EXIF rotations by 90 degrees swap the displayed width and height
+        rotated = meta['orientation'] in (5, 6, 7, 8)
+        shown_size = image.size[::-1] if rotated else image.size
+        target_size = get_downsample_size(shown_size, max_pixels)
+
+        # Baseline JPEGs that fit go into the PDF untouched
+        if not target_size and can_pass_through_jpeg(meta) and not (
+            max_bytes and os.path.getsize(file_path) > max_bytes
+        ):
+            return file_path, image.size, used_cloudconvert, timings
+
+        if image.format == 'JPEG':
+            encoder = "jpeg"
+        if target_size and image.format == 'JPEG':
+            # Let the decoder scale down by 1/2, 1/4 or 1/8 on the fly
+            image.draft('RGB', target_size[::-1] if rotated else target_size)
+
+        if not rotated and is_tiled(image.size, split_box):
+            page_image, img_size, tile_timings = prepare_tiled_page(
+                image, file_path, target_size or image.size, split_box,
+                compression_quality, spill_dir, spill_threshold, encoder,
+                max_bytes, background_color
+            )
+            timings.update(tile_timings)
+        else:
+            image = to_page_image(image, target_size, encoder, background_color)
+            timings['decode'] = time.perf_counter() - start
+            start = time.perf_counter()
+            page_image, img_size = encode_page(
+                image, compression_quality, spill_dir, spill_threshold, encoder,
+                max_bytes, downscale
+            )
+            timings['encode'] = time.perf_counter() - start
+
+    if used_cloudconvert:
+        os.remove(file_path)
+    return page_image, img_size, used_cloudconvert, timings
+
+def estimate_decode_bytes(meta, file_size):
+    """Estimate the memory prepare_page() needs for a file from its header.
+
+    Counts the decoded source plus one 4 byte per pixel RGB working copy.
+    """
+    if not meta:
+        return file_size * UNKNOWN_DECODE_RATIO
+    pixels = meta['width'] * meta['height']
+    return pixels * (DECODE_BYTES_PER_PIXEL.get(meta['mode'], 4) + 4)
+
+def get_split_pieces(img_size, split_box=None):
+    """Return the (x0, y0, x1, y1) pieces a long image is split into.
+
+    An image much wider or taller than split_box, the image box on the
+    page, is cut along its length into as many pages as keep each piece
+    close to the box's shape. Without split_box, or for images that fit
+    one page well enough, the whole image is the only piece.
+    """
+    width, height = img_size
+    if not split_box:
+        return [(0, 0, width, height)]
+    aspect = width / height
+    box_aspect = split_box[0] / split_box[1]
+    if aspect >= box_aspect:
+        count = max(1, round(aspect / box_aspect))
+        cuts = [round(i * width / count) for i in range(count + 1)]
+        return [(x0, 0, x1, height) for x0, x1 in zip(cuts, cuts[1:])]
+    count = max(1, round(box_aspect / aspect))
+    cuts = [round(i * height / count) for i in range(count + 1)]
+    return [(0, y0, width, y1) for y0, y1 in zip(cuts, cuts[1:])]
+
+def open_page_source(file_path, split_box=None):
+    """Open a source image, past Pillow's pixel limit only for strips.
+
+    An image over the limit is opened again with the limit lifted for
+    that header read alone, and kept only when prepare_page() will send
+    it to prepare_tiled_page(); otherwise DecompressionBombError is raised.
+    """
+    try:
+        return Image.open(file_path)
+    except Image.DecompressionBombError:
+        limit = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            image = Image.open(file_path)
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+        rotated = get_image_metadata(image)['orientation'] in (5, 6, 7, 8)
+        if rotated or not is_tiled(image.size, split_box):
+            image.close()
+            raise
+        return image
+
+def is_tiled(img_size, split_box=None):
+    """Check whether an image is prepared in strips by prepare_tiled_page()."""
+    return (
+        img_size[0] * img_size[1] > TILED_MIN_PIXELS
+        or len(get_split_pieces(img_size, split_box)) > 1
+    )
+
+def prepare_tiled_page(image, file_path, img_size, split_box, compression_quality,
+                       spill_dir=None, spill_threshold=None, encoder="auto",
+                       max_bytes=None, background_color=None):
+    """Decode, resample and encode an opened image in strips of rows.
+
+    img_size is the size to resample the image to. Each strip covers about
+    TILE_BYTES of source rows plus the filter margin, is converted and
+    resampled on its own (resize() with a box keeps the edges seamless)
+    and is encoded as its own image. Rows come from open_rows(): for BMP,
+    TIFF and non-interlaced PNG peak memory follows a strip, while JPEG
+    (already scaled down by draft()), GIF and interlaced PNG sources are
+    decoded whole and only the resampling is done in strips. The image
+    is split into pieces, one per PDF page, by get_split_pieces();
+    max_bytes is shared by the strips by area.
+
+    Returns (pieces, img_size, timings) where pieces is a list of
+    (piece_size, tiles) and tiles a list of (tile_image, (x, y, w, h)),
+    placed relative to the piece's top left corner.
+    """
+    timings = {'decode': 0.0, 'encode': 0.0}
+    width, height = img_size
+    scale_x = width / image.width
+    scale_y = height / image.height
+    resampled = img_size != image.size
+    margin = math.ceil(LANCZOS_SUPPORT / scale_y) + 1 if resampled else 0
+    strip_rows = max(1, int(TILE_BYTES // (image.width * 4) * scale_y))
+
+    pieces = get_split_pieces(img_size, split_box)
+    columns = sorted({x for x0, _, x1, _ in pieces for x in (x0, x1)})
+    rows = sorted(
+        set(range(0, height, strip_rows))
+        | {y for _, y0, _, y1 in pieces for y in (y0, y1)}
+    )
+    tiles = [[] for _ in pieces]
+    reader = open_rows(image, file_path)
+    try:
+        for r0, r1 in zip(rows, rows[1:]):
+            start = time.perf_counter()
+            top = max(0, math.floor(r0 / scale_y) - margin)
+            bottom = min(image.height, math.ceil(r1 / scale_y) + margin)
+            strip = to_page_mode(reader.read(top, bottom), encoder, background_color)
+            timings['decode'] += time.perf_counter() - start
+
+            for x0, x1 in zip(columns, columns[1:]):
+                start = time.perf_counter()
+                if resampled:
+                    tile = strip.resize(
+                        (x1 - x0, r1 - r0), Image.LANCZOS,
+                        box=(x0 / scale_x, r0 / scale_y - top, x1 / scale_x, r1 / scale_y - top)
+                    )
+                else:
+                    tile = strip.crop((x0, r0 - top, x1, r1 - top))
+                timings['decode'] += time.perf_counter() - start
+
+                start = time.perf_counter()
+                tile_budget = None
+                if max_bytes:
+                    tile_budget = max(1, max_bytes * (x1 - x0) * (r1 - r0) // (width * height))
+                tile_image, _ = encode_page(
+                    tile, compression_quality, spill_dir, spill_threshold, encoder,
+                    tile_budget
+                )
+                timings['encode'] += time.perf_counter() - start
+
+                index = next(
+                    i for i, (px0, py0, px1, py1) in enumerate(pieces)
+                    if px0 <= x0 < px1 and py0 <= r0 < py1
+                )
+                px0, py0 = pieces[index][:2]
+                tiles[index].append((tile_image, (x0 - px0, r0 - py0, x1 - x0, r1 - r0)))
+            strip.close()
+    finally:
+        reader.close()
+
+    pieces = [
+        ((x1 - x0, y1 - y0), piece_tiles)
+        for (x0, y0, x1, y1), piece_tiles in zip(pieces, tiles)
+    ]
+    return pieces, img_size, timings
+
+def get_page_parts(page_image):
+    """Return the encoded images (bytes or paths) making up a prepared page."""
+    if isinstance(page_image, list):
+        return [tile_image for _, tiles in page_image for tile_image, _ in tiles]
+    return [page_image]
+
+def iter_prepared_pages(jobs, workers, costs=None, decode_budget=DECODE_MEMORY_BUDGET):
+    """Yield prepare_page() results for jobs in order.
+
+    Uses a process pool when more than one worker is requested. Jobs are
+    started in order while the summed costs (estimated decode bytes) of
+    the running jobs stay within decode_budget, so many small images run
+    side by side while a job over the budget on its own waits for the
+    pool to drain and runs alone. At most two jobs per worker are ahead
+    of the consumer.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            yield prepare_page(*job)
+        return
+
+    costs = costs or [0] * len(jobs)
+    executor = ProcessPoolExecutor(max_workers=min(workers, len(jobs)))
+    futures = {}
+    running = {}
+    in_use = 0
+    next_job = 0
+    try:
+        for i in range(len(jobs)):
+            while True:
+                # Finished jobs give their share of the budget back
+                for j in [j for j, future in running.items() if future.done()]:
+                    del running[j]
+                    in_use -= costs[j]
+                while (
+                    next_job < len(jobs) and len(running) < workers
+                    and len(futures) < 2 * workers
+                    and (not running or in_use + costs[next_job] <= decode_budget)
+                ):
+                    future = executor.submit(prepare_page, *jobs[next_job])
+                    futures[next_job] = running[next_job] = future
+                    in_use += costs[next_job]
+                    next_job += 1
+                if futures[i].done():
+                    break
+                wait(list(running.values()), return_when=FIRST_COMPLETED)
+            yield futures.pop(i).result()
+    finally:
+        # Drop queued jobs when the consumer stops early (e.g. cancelled)
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def get_page_cache_key(file_hash, compression_quality, max_pixels, *settings):
+    """Return the page cache key for a source file and its encode settings.
+
+    settings are any further prepare_page() arguments that change the
+    encoded page.
+    """
+    box = "original" if not max_pixels else f"{round(max_pixels[0])}x{round(max_pixels[1])}"
+    key = ":".join(
+        str(part) for part in (file_hash, compression_quality, box) + settings
+    )
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def may_be_transparent(meta):
+    """Check from header metadata whether an image may need flattening.
+
+    Files scanned before transparency was recorded count as transparent.
+    """
+    return not meta or meta.get('transparent', True)
+
+def load_cached_page(key, cache_dir=PAGE_CACHE_DIR):
+    """Return a ready page from the page cache, or None on a miss."""
+    for suffix in PAGE_CACHE_SUFFIXES:
+        cache_path = os.path.join(cache_dir, key + suffix)
+        try:
+            with Image.open(cache_path) as img:
+                img_size = img.size
+            # Touch the entry so eviction sees it as recently used
+            os.utime(cache_path)
+        except (OSError, Image.UnidentifiedImageError):
+            continue
+        return cache_path, img_size, False
+    return None
+
+def store_cached_page(key, page_image, cache_dir=PAGE_CACHE_DIR):
+    """Save an encoded page (bytes or path) into the page cache."""
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        suffix = ".jpg" if get_page_codec(page_image) == "dct" else ".png"
+        cache_path = os.path.join(cache_dir, key + suffix)
+        # A private temp name, as shard processes may store the same page
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as f:
+            if isinstance(page_image, bytes):
+                f.write(page_image)
+            else:
+                with open(page_image, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Could not cache page {key}: {e}")
+
+def evict_page_cache(max_bytes=PAGE_CACHE_MAX_BYTES, cache_dir=PAGE_CACHE_DIR):
+    """Delete least recently used pages until the cache fits in max_bytes."""
+    try:
+        with os.scandir(cache_dir) as it:
+            entries = [
+                (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                for entry in it if entry.name.endswith(PAGE_CACHE_SUFFIXES)
+            ]
+    except FileNotFoundError:
+        return
+    total = sum(size for _, size, _ in entries)
+    evicted = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+    if evicted:
+        logging.info(f"Evicted {evicted} pages from the page cache")
+
+def create_pdf(pdf_options, shared_layers=False):
+    """Create a CustomPDF document from the PDF options dict."""
+    orientation = pdf_options.get('orientation', 'P')
+    page_size = pdf_options.get('page_size', 'A4')
+    custom_size = pdf_options.get('custom_size', None)
+    watermark = pdf_options.get('watermark', None)
+    font = pdf_options.get('font', None)
+    background_color = pdf_options.get('background_color', None)
+
+    if page_size == 'Custom' and custom_size:
+        page_format = custom_size
+    else:
+        page_format = page_size
+
+    pdf = CustomPDF(
+        orientation=orientation, format=page_format, watermark_text=watermark,
+        font=font, background_color=background_color,
+        watermark_image=pdf_options.get('watermark_image', None),
+        shared_layers=shared_layers
+    )
+    pdf.page_numbers = pdf_options.get('page_numbers', False)
+    return pdf
+
+def render_page_layers(pdf_options):
+    """Render what CustomPDF draws under and over every page, once each.
+
+    Returns (under, over): one-page PDFs as bytes holding the background
+    color and text watermark, and the image watermark, or None for a
+    layer with nothing in it. PdfStreamWriter.add_layers() makes them
+    form XObjects shared by all pages.
+    """
+    def render(options):
+        pdf = create_pdf(dict(options, page_numbers=False))
+        pdf.add_page()
+        return bytes(pdf.output())
+
+    under = over = None
+    if pdf_options.get('background_color') or pdf_options.get('watermark'):
+        under = render(dict(pdf_options, watermark_image=None))
+    if pdf_options.get('watermark_image'):
+        over = render(dict(pdf_options, background_color=None, watermark=None))
+    return under, over
+
+def get_image_box(pdf, orientation):
+    """Return the (width, height) available for the image on a page."""
+    if orientation == 'P':
+        return pdf.w - 20, pdf.h - 30
+    return pdf.w - 30, pdf.h - 20
+
+def get_image_box_pixels(pdf, orientation, target_dpi):
+    """Return the image box size in pixels at target_dpi, or None."""
+    if not target_dpi:
+        return None
+    max_w, max_h = get_image_box(pdf, orientation)
+    # pdf.k is points per user unit; there are 72 points per inch
+    return (
+        max_w * pdf.k / 72 * target_dpi,
+        max_h * pdf.k / 72 * target_dpi
+    )
+
+def get_page_budget(pdf_options, pages, reserved=0):
+    """Return the most bytes each new page may take, or None for no limit.
+
+    max_pdf_bytes is shared evenly by the pages once reserved bytes (an
+    existing PDF appended to, PDFs merged in) and PDF_PAGE_OVERHEAD per
+    page are set aside; max_page_bytes caps every page on its own. The
+    smaller limit wins.
+    """
+    budgets = []
+    if pdf_options.get('max_page_bytes'):
+        budgets.append(pdf_options['max_page_bytes'])
+    if pdf_options.get('max_pdf_bytes') and pages:
+        share = (pdf_options['max_pdf_bytes'] - reserved) // pages - PDF_PAGE_OVERHEAD
+        if share <= 0:
+            logging.warning(
+                f"No room left for {pages} pages in {pdf_options['max_pdf_bytes']} bytes"
+            )
+        budgets.append(max(1, share))
+    return min(budgets) if budgets else None
+
+def get_image_placement(pdf, img_size, orientation):
+    """Return (x, y, ratio) placing img_size pixels scaled to fit and centered."""
+    # Calculate image placement
+    max_w, max_h = get_image_box(pdf, orientation)
+
+    # Scale image
+    img_w, img_h = img_size
+    ratio = min(max_w/img_w, max_h/img_h)
+    new_w = img_w * ratio
+    new_h = img_h * ratio
+
+    # Center image
+    x = (pdf.w - new_w) / 2
+    y = (pdf.h - new_h) / 2
+    return x, y, ratio
+
+def add_image_page(pdf, page_image, img_size, orientation):
+    """Add a page holding the JPEG or PNG (bytes or path) scaled to fit and centered.
+
+    A tiled page from prepare_tiled_page() adds one page per piece.
+    Returns the number of pages added.
+    """
+    if isinstance(page_image, list):
+        for piece_size, tiles in page_image:
+            pdf.add_page()
+            x, y, ratio = get_image_placement(pdf, piece_size, orientation)
+            for tile_image, (tile_x, tile_y, tile_w, tile_h) in tiles:
+                if isinstance(tile_image, bytes):
+                    tile_image = BytesIO(tile_image)
+                pdf.image(
+                    tile_image, x + tile_x * ratio, y + tile_y * ratio,
+                    tile_w * ratio, tile_h * ratio
+                )
+        return len(page_image)
+
+    pdf.add_page()
+    x, y, ratio = get_image_placement(pdf, img_size, orientation)
+
+    # fpdf copies JPEG data into the document without re-encoding it;
+    # PNG pages are stored with Flate in their own color type
+    if isinstance(page_image, bytes):
+        page_image = BytesIO(page_image)
+    pdf.image(page_image, x, y, img_size[0] * ratio, img_size[1] * ratio)
+    return 1
+
+def count_pdf_pages(pdf_path):
+    """Return the number of pages in a PDF file."""
+    from PyPDF2 import PdfReader
+    with open(pdf_path, 'rb') as f:
+        return len(PdfReader(f).pages)
+
+def open_pdf_writer(output_pdf, append=False):
+    """Return a PdfStreamWriter for output_pdf.
+
+    With append, new pages go after those of the existing output_pdf, in
+    an incremental update when it can be updated in place and otherwise
+    by copying it into a rewritten file first.
+    """
+    from pdf_tools import PdfStreamWriter
+    if not append:
+        return PdfStreamWriter(output_pdf)
+    try:
+        return PdfStreamWriter(output_pdf, append=True)
+    except ValueError as e:
+        logging.info(f"Rewriting {output_pdf} to append pages: {e}")
+    writer = PdfStreamWriter(output_pdf)
+    try:
+        writer.add_document(output_pdf)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer
+
+def append_to_pdf(pdf_path, new_pdf):
+    """Append the pages of new_pdf (bytes or path) to the PDF at pdf_path.
+
+    Uses an incremental update so only the new pages are written; PDFs
+    that cannot be updated in place are rewritten with merge_pdfs().
+    """
+    from pdf_tools import append_pages
+    try:
+        pages = append_pages(pdf_path, new_pdf)
+        logging.info(f"Appended {pages} pages to {pdf_path} incrementally")
+        return
+    except ValueError as e:
+        logging.info(f"Rewriting {pdf_path} to append pages: {e}")
+    merge_pdfs([pdf_path, new_pdf], pdf_path)
+
 def merge_pdfs(pdf_files, output_path):
-    """Merge multiple PDF files into one."""
-    from PyPDF2 import PdfMerger
-    merger = PdfMerger()
-    for pdf in pdf_files:
-        merger.append(pdf)
-    merger.write(output_path)
-    merger.close()
+    """Merge multiple PDF files (paths or bytes) into one.
+
+    Pages are streamed to output_path one at a time, so large merge sets
+    are never held in memory together. output_path may be one of the
+    inputs; it is replaced once the merge is complete.
+    """
+    from pdf_tools import merge_documents
+    merge_documents(pdf_files, output_path)
+
+class ConversionError(Exception):
+    """Raised when a conversion fails; report_path points at the error report."""
+    def __init__(self, message, report_path=None):
+        super().__init__(message)
+        self.report_path = report_path
+
+def parse_color(text):
+    """Parse an "R,G,B" string into a tuple of ints, or None when empty."""
+    if not text:
+        return None
+    if isinstance(text, (tuple, list)):
+        return tuple(text)
+    try:
+        parts = [int(part) for part in text.split(",")]
+    except ValueError:
+        parts = []
+    if len(parts) != 3 or not all(0 <= part <= 255 for part in parts):
+        raise ValueError(f"Invalid color: {text!r} (expected R,G,B)")
+    return tuple(parts)
+
+def write_error_report(error, conversion_issues):
+    """Write an error report into the log directory and return its path."""
+    report_path = os.path.join(LOG_DIR, f"error_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
+    with open(report_path, 'w') as f:
+        f.write(f"Error Report\n\nTimestamp: {datetime.now()}\n")
+        f.write(f"Error: {str(error)}\n\n")
+        f.write("Conversion Issues:\n")
+        for fname, issues in conversion_issues.items():
+            f.write(f"{fname}: {', '.join(issues)}\n")
+    return report_path
+
+def no_progress(done, total, message, bytes_done=0):
+    """Progress callback that ignores the report."""
+
+def takes_bytes_done(callback):
+    """Check whether a progress callback accepts the bytes_done argument.
+
+    Callbacks written for callback(done, total, message) are still called
+    with those three arguments only.
+    """
+    try:
+        inspect.signature(callback).bind(0, 0, "", 0)
+    except TypeError:
+        return False
+    except ValueError:  # No signature to inspect (some builtins)
+        return True
+    return True
+
+def build_pdf(files_info, output_pdf, compression_quality, pdf_options,
+              workers, memory_budget=PAGE_MEMORY_BUDGET, use_page_cache=True,
+              append=False, report=no_progress, cancel_event=None,
+              page_number_offset=0, metrics=None,
+              decode_budget=DECODE_MEMORY_BUDGET):
+    """Write the scanned files in files_info, in order, into one PDF.
+
+    report(done, total, message, bytes_done) gets progress; page numbers
+    start after page_number_offset. Returns (output_pdf, pages), the path
+    written and the PDF pages made, or (None, files done) when cancelled.
+    """
+    metrics = metrics or ConversionMetrics()
+
+    # Create PDF with custom options before decoding anything, so every
+    # image can be placed on its page and released straight away
+    orientation = pdf_options.get('orientation', 'P')
+    pdf = create_pdf(pdf_options, shared_layers=True)
+    append_to = output_pdf if append and os.path.exists(output_pdf) else None
+    if append_to:
+        page_number_offset += count_pdf_pages(append_to)
+    pdf.page_number_offset = page_number_offset
+    max_pixels = get_image_box_pixels(
+        pdf, orientation, pdf_options.get('target_dpi')
+    )
+    encoder = pdf_options.get('encoder') or "auto"
+    downscale = pdf_options.get('fit_downscale', False)
+    background_color = pdf_options.get('background_color')
+    split_box = None
+    if pdf_options.get('split_long_images'):
+        split_box = get_image_box(pdf, orientation)
+
+    # PDFs to merge are added after the new pages, once: a PDF appended
+    # to got them when it was created
+    merge_files = pdf_options.get('merge_files') or []
+    if append_to and merge_files:
+        logging.info(f"Not merging {len(merge_files)} PDFs again into {append_to}")
+        merge_files = []
+    total = len(files_info)
+    max_bytes = get_page_budget(
+        pdf_options, total,
+        sum(os.path.getsize(path) for path in merge_files)
+        + (os.path.getsize(append_to) if append_to else 0)
+    )
+    if max_bytes:
+        logging.info(f"Fitting each page into {max_bytes} bytes")
+
+    # Appending runs keep one growing PDF under the given name
+    if merge_files and not append:
+        output_pdf = os.path.splitext(output_pdf)[0] + "_merged.pdf"
+    size_before = os.path.getsize(append_to) if append_to else 0
+    writer = open_pdf_writer(output_pdf, append_to is not None)
+    # The watermarks and background are written once and shared by the
+    # new pages, not by the pages appended to nor the merged PDFs
+    try:
+        layers = writer.add_layers(*render_page_layers(pdf_options))
+    except BaseException:
+        writer.abort()
+        raise
+    # A rewritten PDF being appended to holds its old pages already
+    pages_before = writer.pages
+    # Encoded bytes placed in pdf since its pages were last written out
+    pending_bytes = 0
+
+    def flush():
+        """Copy the pages placed so far into the output file and start afresh."""
+        nonlocal pdf, pending_bytes
+        if pdf.page:
+            with metrics.stage('write'):
+                writer.add_document(pdf.output(), layers)
+        pdf = create_pdf(pdf_options, shared_layers=True)
+        pdf.page_number_offset = page_number_offset + writer.pages - pages_before
+        pending_bytes = 0
+        # fpdf documents are full of reference cycles; free the images of
+        # the one just written now rather than whenever gc gets to it
+        gc.collect()
+
+    # Decode and encode in worker processes; pages come back in the
+    # sorted order and are appended here by a single writer. Encoded
+    # pages travel in memory unless they would blow the memory budget,
+    # in which case they go through a private temp dir.
+    spill_dir = tempfile.mkdtemp(prefix="heic2pdf_")
+    spill_threshold = memory_budget // (2 * workers)
+    prepared_pages = None
+    try:
+        # Pass-through JPEGs are placed straight from their scan metadata,
+        # and pages encoded by an earlier run come from the page cache
+        ready_pages = {}
+        page_sources = {}
+        cache_keys = {}
+        for i, file_info in enumerate(files_info):
+            page = get_passthrough_page(file_info, max_pixels, max_bytes, split_box)
+            page_sources[i] = "passthrough"
+            if not page and use_page_cache:
+                # The page color only shows through transparent images
+                cache_keys[i] = get_page_cache_key(
+                    file_info['hash'], compression_quality, max_pixels, encoder,
+                    max_bytes, downscale,
+                    background_color if may_be_transparent(file_info.get('meta')) else None,
+                    split_box
+                )
+                page = load_cached_page(cache_keys[i])
+                page_sources[i] = "cache"
+            if page:
+                ready_pages[i] = page + ({},)
+            else:
+                page_sources[i] = "encoded"
+        if ready_pages:
+            logging.info(f"{len(ready_pages)} of {total} pages need no decoding")
+
+        # Without pyheif, send the remaining HEIC files to CloudConvert up
+        # front in a few batched jobs instead of one job per worker call
+        cloud_converted = {}
+        heic_paths = [
+            f['path'] for i, f in enumerate(files_info)
+            if i not in ready_pages and f['path'].lower().endswith(".heic")
+        ]
+        if heic_paths and not pyheif_available():
+            report(0, total, f"Converting {len(heic_paths)} HEIC files with CloudConvert")
+            with metrics.stage('cloudconvert', len(heic_paths)):
+                cloud_converted = convert_heic_batch_with_cloudconvert(heic_paths, spill_dir)
+
+        jobs = [
+            (cloud_converted.get(f['path'], f['path']), compression_quality,
+             max_pixels, spill_dir, spill_threshold, encoder, max_bytes,
+             downscale, background_color, split_box)
+            for i, f in enumerate(files_info) if i not in ready_pages
+        ]
+        costs = [
+            estimate_decode_bytes(f.get('meta'), f['size'])
+            for i, f in enumerate(files_info) if i not in ready_pages
+        ]
+        prepared_pages = iter_prepared_pages(jobs, workers, costs, decode_budget)
+
+        bytes_done = 0
+        report(0, total, f"Converting {total} files")
+        for i, file_info in enumerate(files_info):
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info(f"Conversion cancelled after {i} of {total} pages")
+                writer.abort()
+                return None, i
+
+            file_path = file_info['path']
+            if i in ready_pages:
+                page_image, img_size, used_cloudconvert, timings = ready_pages.pop(i)
+            else:
+                page_image, img_size, used_cloudconvert, timings = next(prepared_pages)
+                # Cache what was encoded here, not the untouched sources
+                # nor tiled pages
+                if i in cache_keys and (
+                    isinstance(page_image, bytes)
+                    or (isinstance(page_image, str)
+                        and os.path.dirname(page_image) == spill_dir)
+                ):
+                    store_cached_page(cache_keys[i], page_image)
+            if used_cloudconvert:
+                report(i, total, f"Fell back to CloudConvert for {os.path.basename(file_path)}", bytes_done)
+
+            # Place the page now; nothing decoded is kept for the next file
+            start = time.perf_counter()
+            pages = add_image_page(pdf, page_image, img_size, orientation)
+            timings['embed'] = time.perf_counter() - start
+            parts = get_page_parts(page_image)
+            page_bytes = sum(
+                len(part) if isinstance(part, bytes) else os.path.getsize(part)
+                for part in parts
+            )
+            codec = "+".join(sorted({get_page_codec(part) for part in parts}))
+            metrics.file(
+                file_path, file_info['size'], timings, page_bytes, pages,
+                source=page_sources[i], codec=codec
+            )
+            for part in parts:
+                if isinstance(part, str) and os.path.dirname(part) == spill_dir:
+                    os.remove(part)
+            pending_bytes += page_bytes
+            if pending_bytes >= PDF_FLUSH_BYTES:
+                flush()
+
+            bytes_done += file_info['size']
+            report(i + 1, total, f"Processed: {os.path.basename(file_path)} ({i + 1}/{total})", bytes_done)
+
+        flush()
+        pages = writer.pages - pages_before
+        with metrics.stage('write'):
+            for merge_file in merge_files:
+                writer.add_document(merge_file)
+            writer.close()
+    except BaseException:
+        writer.abort()
+        raise
+    finally:
+        if prepared_pages is not None:
+            prepared_pages.close()
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+    output_bytes = os.path.getsize(output_pdf)
+    metrics.bytes_out += output_bytes - size_before
+    max_pdf_bytes = pdf_options.get('max_pdf_bytes')
+    if max_pdf_bytes and output_bytes > max_pdf_bytes:
+        logging.warning(
+            f"{output_pdf} is {output_bytes} bytes, over the {max_pdf_bytes} byte target"
+        )
+
+    return output_pdf, pages
+
+def build_shard(files_info, shard_path, compression_quality, pdf_options,
+                workers, memory_budget, use_page_cache, page_number_offset,
+                decode_budget=DECODE_MEMORY_BUDGET, cancel_event=None):
+    """Build one shard PDF in a worker process, with its own page workers.
+
+    cancel_event must be shareable between processes, such as a
+    multiprocessing.Manager().Event(). Returns its path (None when
+    cancelled) and its metrics, for ConversionMetrics.merge().
+    """
+    metrics = RecordingMetrics()
+    output_pdf, _ = build_pdf(
+        files_info, shard_path, compression_quality, pdf_options, workers,
+        memory_budget, use_page_cache, cancel_event=cancel_event,
+        page_number_offset=page_number_offset, metrics=metrics,
+        decode_budget=decode_budget
+    )
+    return output_pdf, metrics.export()
+
+def get_shard_path(output_pdf, index):
+    """Return the path of shard number index (from 1) of output_pdf."""
+    return f"{os.path.splitext(output_pdf)[0]}_{index:03d}.pdf"
+
+def split_shards(files_info, max_pages=None, max_bytes=None, shard_by=None):
+    """Split sorted files into shards, keeping their order.
+
+    Files are grouped by parent folder or by modification date first when
+    shard_by says so, then each group is cut whenever the next file would
+    exceed max_pages or max_bytes of source data.
+    """
+    groups = {}
+    for file_info in files_info:
+        if shard_by == "folder":
+            key = os.path.dirname(file_info['path'])
+        elif shard_by == "date":
+            key = datetime.fromtimestamp(file_info['modified']).date()
+        else:
+            key = None
+        groups.setdefault(key, []).append(file_info)
+
+    shards = []
+    for group in groups.values():
+        shard, shard_bytes = [], 0
+        for file_info in group:
+            if shard and (
+                (max_pages and len(shard) >= max_pages)
+                or (max_bytes and shard_bytes + file_info['size'] > max_bytes)
+            ):
+                shards.append(shard)
+                shard, shard_bytes = [], 0
+            shard.append(file_info)
+            shard_bytes += file_info['size']
+        shards.append(shard)
+    return shards
+
+def build_shards(shards, output_pdf, compression_quality, pdf_options,
+                 workers, memory_budget=PAGE_MEMORY_BUDGET, use_page_cache=True,
+                 report=no_progress, cancel_event=None, metrics=None,
+                 decode_budget=DECODE_MEMORY_BUDGET):
+    """Build every shard PDF, one process per shard, and return their paths.
+
+    Shards built side by side split the workers, memory_budget and
+    decode_budget between them. Page numbers run on across shards and PDFs to merge are appended to
+    the last shard, and shard metrics are merged into metrics. Returns
+    None, leaving no shards behind, when cancel_event is set before all
+    shards are built.
+    """
+    metrics = metrics or ConversionMetrics()
+    merge_files = pdf_options.get('merge_files') or []
+    shard_options = dict(pdf_options, merge_files=None)
+    shard_paths = [get_shard_path(output_pdf, i + 1) for i in range(len(shards))]
+    offsets = list(accumulate((len(shard) for shard in shards), initial=0))
+    total = offsets[-1]
+    report(0, total, f"Building {len(shards)} PDFs")
+
+    if workers <= 1 or len(shards) <= 1:
+        # One shard at a time, each using all the workers for its pages
+        for shard, shard_path, offset in zip(shards, shard_paths, offsets):
+            def report_shard(done, _total, message, bytes_done=0):
+                report(offset + done, total, message, bytes_done)
+            built, _ = build_pdf(
+                shard, shard_path, compression_quality, shard_options,
+                workers, memory_budget, use_page_cache, report=report_shard,
+                cancel_event=cancel_event, page_number_offset=offset,
+                metrics=metrics, decode_budget=decode_budget
+            )
+            if built is None:
+                remove_files(shard_paths)
+                return None
+    else:
+        # Each concurrent shard gets an equal share of the page workers
+        concurrent = min(workers, len(shards))
+        # Shard processes cannot see cancel_event; a manager event relays
+        # it so they stop at the next page, like a single PDF does
+        manager = multiprocessing.Manager() if cancel_event is not None else None
+        shard_cancel = manager.Event() if manager is not None else None
+        executor = ProcessPoolExecutor(max_workers=concurrent)
+        try:
+            futures = {
+                executor.submit(
+                    build_shard, shard, shard_path, compression_quality,
+                    shard_options, max(1, workers // concurrent),
+                    memory_budget // concurrent, use_page_cache, offset,
+                    decode_budget // concurrent, shard_cancel
+                ): (shard, shard_path)
+                for shard, shard_path, offset in zip(shards, shard_paths, offsets)
+            }
+            pages_done = 0
+            bytes_done = 0
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _, shard_metrics = future.result()
+                    metrics.merge(shard_metrics)
+                    shard, shard_path = futures[future]
+                    pages_done += len(shard)
+                    bytes_done += sum(f['size'] for f in shard)
+                    report(pages_done, total, f"Built {os.path.basename(shard_path)}", bytes_done)
+                if cancel_event is not None and cancel_event.is_set():
+                    logging.info(f"Sharded conversion cancelled after {pages_done} of {total} pages")
+                    shard_cancel.set()
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    remove_files(shard_paths)
+                    return None
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            if manager is not None:
+                manager.shutdown()
+
+    if merge_files:
+        with metrics.stage('write', len(merge_files)):
+            for merge_file in merge_files:
+                append_to_pdf(shard_paths[-1], merge_file)
+    metrics.bytes_out = sum(os.path.getsize(path) for path in shard_paths)
+    logging.info(f"Built {len(shards)} shards of {output_pdf}")
+    return shard_paths
+
+def remove_files(paths):
+    """Delete the files that exist among paths."""
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def write_shard_manifest(output_pdf, input_folder, shards, shard_paths):
+    """Write name_manifest.json describing the shards and return its path."""
+    manifest_path = f"{os.path.splitext(output_pdf)[0]}_manifest.json"
+    first_page = 1
+    entries = []
+    for shard, shard_path in zip(shards, shard_paths):
+        entries.append({
+            'file': os.path.basename(shard_path),
+            'first_page': first_page,
+            'pages': len(shard),
+            'bytes': os.path.getsize(shard_path),
+            'sources': [file_info['path'] for file_info in shard]
+        })
+        first_page += len(shard)
+    with open(manifest_path, 'w') as f:
+        json.dump({
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'source': os.path.abspath(input_folder),
+            'pages': first_page - 1,
+            'shards': entries
+        }, f, indent=2)
+    return manifest_path
+
+def convert_folder_to_pdf(input_folder, output_pdf, compression_quality=85,
+                          supported_formats=SUPPORTED_FORMATS, pdf_options=None,
+                          recursive=True, min_date=None, skip_converted=True,
+                          delete_source=False, workers=None,
+                          hash_algorithm=HASH_ALGORITHM,
+                          progress_callback=None, confirm_issues=None,
+                          cancel_event=None, memory_budget=PAGE_MEMORY_BUDGET,
+                          use_page_cache=True, append=False, shard_pages=None,
+                          shard_bytes=None, shard_by=None, write_manifest=True,
+                          metrics=None, files=None,
+                          decode_budget=DECODE_MEMORY_BUDGET):
+    """Convert the supported images in a folder into one PDF.
+
+    progress_callback(done, total, message[, bytes_done]) gets progress;
+    confirm_issues(conversion_issues) may decline after the pre-scan;
+    cancel_event stops at the next page without writing the PDF.
+    memory_budget and decode_budget cap encoded and decoded bytes in flight.
+    append adds the pages to an existing output_pdf; shard_pages,
+    shard_bytes or shard_by split the output into numbered PDFs (and a
+    manifest unless write_manifest is False). files limits the run to
+    those paths. Returns a dict with 'status', 'output', 'pages' and, for
+    converted runs, 'metrics'. Raises ConversionError on failure.
+    """
+    with_bytes_done = progress_callback is not None and takes_bytes_done(progress_callback)
+
+    def report(done, total, message, bytes_done=0):
+        if with_bytes_done:
+            progress_callback(done, total, message, bytes_done)
+        elif progress_callback:
+            progress_callback(done, total, message)
+
+    sharded = bool(shard_pages or shard_bytes or shard_by)
+    if sharded and append:
+        raise ValueError("append cannot be combined with sharding")
+    if sharded and (pdf_options or {}).get('split_long_images'):
+        raise ValueError("split_long_images cannot be combined with sharding")
+    if shard_by not in (None,) + SHARD_BY:
+        raise ValueError(f"shard_by must be one of {SHARD_BY}")
+    output_pdf_base = output_pdf
+    metrics = metrics or ConversionMetrics()
 
-def heic_to_pdf_with_fallback(input_folder, output_pdf, compression_quality, supported_formats, 
-                            progress_bar, status_label, pdf_options=None, recursive=True, min_date=None, 
-                            skip_converted=True, delete_source=False):
-    """Enhanced conversion function with new features."""
     conversion_issues = {}
+    history = None
     try:
-        # Load conversion history
-        history = load_conversion_history()
+        # Open conversion history
+        history = ConversionHistory()
         
         # Scan for files
-        files_info = scan_directory(input_folder, supported_formats, min_date)
+        if files is not None:
+            files_info = scan_files(
+                files, supported_formats, min_date, hash_algorithm, metrics=metrics
+            )
+        else:
+            report(0, 0, f"Scanning {input_folder}")
+            files_info = scan_directory(
+                input_folder, supported_formats, min_date, hash_algorithm, recursive,
+                metrics=metrics
+            )
         if not files_info:
-            messagebox.showwarning("No Files", "No matching files found!")
-            return
+            return {'status': 'no_files', 'output': None, 'pages': 0}
 
         # Filter already converted files
         if skip_converted:
+            converted = history.get_timestamps(f['hash'] for f in files_info)
             files_info = [f for f in files_info 
-                        if f['hash'] not in history or 
-                        history[f['hash']]['timestamp'] < f['modified']] 
+                        if f['hash'] not in converted or 
+                        converted[f['hash']] < f['modified']] 
 
         if not files_info:
-            messagebox.showinfo("Info", "All files are up to date!")
-            return
+            return {'status': 'up_to_date', 'output': None, 'pages': 0}
 
-        # Sort files by modification date
-        files_info.sort(key=lambda x: x['modified'])
+        # Sort files by modification date; the path breaks ties so files
+        # with equal times keep the same order on every run
+        files_info.sort(key=lambda x: (x['modified'], x['path']))
 
-        # Pre-scan for potential issues
-        for file_info in files_info:
-            file_path = file_info['path']
-            issues = check_image_issues(file_path)
-            if issues:
-                conversion_issues[file_info['path']] = issues
-                logging.warning(f"Issues detected in {file_info['path']}: {issues}")
-
-        # Show preview of issues if any
-        if conversion_issues:
-            issues_text = "\n".join(
-                f"{fname}: {', '.join(issues)}"
-                for fname, issues in conversion_issues.items()
-            )
-            if not messagebox.askyesno("Potential Issues", 
-                f"The following issues were detected:\n\n{issues_text}\n\nContinue anyway?"):
-                return
+        # Pre-scan for potential issues, from the headers read by the scan
+        with metrics.stage('issue_check', len(files_info)):
+            for file_info in files_info:
+                file_path = file_info['path']
+                if file_info['meta'] is not None:
+                    issues = check_metadata_issues(file_info['meta'], file_info['size'])
+                else:
+                    issues = check_image_issues(file_path)
+                if issues:
+                    conversion_issues[file_info['path']] = issues
+                    logging.warning(f"Issues detected in {file_info['path']}: {issues}")
 
-        images = []
-        progress_bar["maximum"] = len(files_info)
-        progress_bar["value"] = 0
+        # Let the caller review the issues if any
+        if conversion_issues and confirm_issues and not confirm_issues(conversion_issues):
+            return {'status': 'declined', 'output': None, 'pages': 0}
 
-        for i, file_info in enumerate(files_info):
-            file_path = file_info['path']
-            output_image_path = os.path.join(input_folder, f"converted_{os.path.splitext(os.path.basename(file_path))[0]}.jpg")
+        if cancel_event is not None and cancel_event.is_set():
+            return {'status': 'cancelled', 'output': None, 'pages': 0}
 
-            # Handle HEIC files
-            if file_path.lower().endswith(".heic"):
-                try:
-                    # Attempt to convert HEIC locally
-                    import pyheif
-                    heif_file = pyheif.read(file_path)
-                    image = Image.frombytes(
-                        heif_file.mode, heif_file.size, heif_file.data,
-                        "raw", heif_file.mode, heif_file.stride
-                    )
-                    if image.mode != "RGB":
-                        image = image.convert("RGB")
-                    image.save(output_image_path, "JPEG", quality=compression_quality)
-                except ImportError:
-                    # Fallback to CloudConvert
-                    status_label.config(text=f"Falling back to CloudConvert for {os.path.basename(file_path)}")
-                    convert_heic_to_jpeg_with_cloudconvert(file_path, output_image_path)
-            else:
-                # Handle JPEG, PNG, BMP, and GIF directly
-                image = Image.open(file_path)
-                if image.mode != "RGB":
-                    image = image.convert("RGB")
-                image.save(output_image_path, "JPEG", quality=compression_quality)
-
-            images.append(Image.open(output_image_path))
-            progress_bar["value"] += 1
-            status_label.config(text=f"Processed: {os.path.basename(file_path)} ({i + 1}/{len(files_info)})")
-            progress_bar.update_idletasks()
-
-        # Create PDF with custom options
         pdf_options = pdf_options or {}
-        orientation = pdf_options.get('orientation', 'P')
-        page_size = pdf_options.get('page_size', 'A4')
-        custom_size = pdf_options.get('custom_size', None)
-        watermark = pdf_options.get('watermark', None)
-        page_numbers = pdf_options.get('page_numbers', False)
-        font = pdf_options.get('font', None)
-        background_color = pdf_options.get('background_color', None)
-        
-        if page_size == 'Custom' and custom_size:
-            pdf = CustomPDF(orientation=orientation, format=custom_size, watermark_text=watermark, font=font, background_color=background_color)
+        workers = workers or os.cpu_count() or 1
+        if sharded:
+            shards = split_shards(files_info, shard_pages, shard_bytes, shard_by)
+            shard_paths = build_shards(
+                shards, output_pdf, compression_quality, pdf_options, workers,
+                memory_budget, use_page_cache, report, cancel_event, metrics,
+                decode_budget
+            )
+            if shard_paths is None:
+                return {'status': 'cancelled', 'output': None, 'pages': 0}
+            # Long images are not split when sharding; one page per file
+            pages = len(files_info)
+            outputs = [
+                (file_info, shard_path)
+                for shard, shard_path in zip(shards, shard_paths)
+                for file_info in shard
+            ]
+            output_pdf = shard_paths[0]
+            if write_manifest:
+                output_pdf = write_shard_manifest(
+                    output_pdf_base, input_folder, shards, shard_paths
+                )
         else:
-            pdf = CustomPDF(orientation=orientation, format=page_size, watermark_text=watermark, font=font, background_color=background_color)
-        
-        pdf.page_numbers = page_numbers
-        
-        # Process images
-        for img in images:
-            pdf.add_page()
-            
-            # Calculate image placement
-            if orientation == 'P':
-                max_w = pdf.w - 20
-                max_h = pdf.h - 30
-            else:
-                max_w = pdf.w - 30
-                max_h = pdf.h - 20
-                
-            # Scale image
-            img_w, img_h = img.size
-            ratio = min(max_w/img_w, max_h/img_h)
-            new_w = img_w * ratio
-            new_h = img_h * ratio
-            
-            # Center image
-            x = (pdf.w - new_w) / 2
-            y = (pdf.h - new_h) / 2
-            
-            temp_image_path = "temp_image.jpg"
-            img.save(temp_image_path, "JPEG", quality=compression_quality)
-            pdf.image(temp_image_path, x, y, new_w, new_h)
-            os.remove(temp_image_path)
-
-        pdf.output(output_pdf)
-        
-        # Handle PDF merging if requested
-        if pdf_options.get('merge_files'):
-            merge_files = pdf_options['merge_files']
-            if merge_files:
-                temp_output = output_pdf
-                final_output = os.path.splitext(output_pdf)[0] + "_merged.pdf"
-                merge_pdfs([temp_output] + merge_files, final_output)
-                os.remove(temp_output)  # Remove temporary PDF
-                output_pdf = final_output
-
-        messagebox.showinfo("Success", f"PDF created successfully: {output_pdf}")
+            output_pdf, pages = build_pdf(
+                files_info, output_pdf, compression_quality, pdf_options,
+                workers, memory_budget, use_page_cache, append, report,
+                cancel_event, metrics=metrics, decode_budget=decode_budget
+            )
+            if output_pdf is None:
+                return {'status': 'cancelled', 'output': None, 'pages': pages}
+            outputs = [(file_info, output_pdf) for file_info in files_info]
+        if use_page_cache:
+            evict_page_cache()
+
         logging.info(f"Successfully created PDF: {output_pdf}")
 
         # Update conversion history
-        for file_info in files_info:
-            history[file_info['hash']] = {
-                'path': file_info['path'],
-                'timestamp': datetime.now().timestamp(),
-                'output': output_pdf
-            }
+        history.record(
+            (file_info['hash'], file_info['path'], file_output)
+            for file_info, file_output in outputs
+        )
         
         # Delete source files if requested
         if delete_source:
@@ -379,26 +2036,66 @@ def heic_to_pdf_with_fallback(input_folder, output_pdf, compression_quality, sup
                     logging.info(f"Deleted source file: {file_info['path']}")
                 except Exception as e:
                     logging.error(f"Failed to delete {file_info['path']}: {e}")
-        
-        # Save updated history
-        save_conversion_history(history)
+
+        result = {'status': 'converted', 'output': output_pdf, 'pages': pages}
+        if sharded:
+            result['shards'] = shard_paths
+        result['metrics'] = metrics.close(status='converted', output=output_pdf)
+        logging.info(f"Conversion metrics: {format_summary(result['metrics'])}")
+        return result
 
     except Exception as e:
         error_msg = f"Error during conversion: {str(e)}"
         logging.error(error_msg, exc_info=True)
-        messagebox.showerror("Error", error_msg)
-        
-        # Generate error report
-        report_path = os.path.join(LOG_DIR, f"error_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt")
-        with open(report_path, 'w') as f:
-            f.write(f"Error Report\n\nTimestamp: {datetime.now()}\n")
-            f.write(f"Error: {str(e)}\n\n")
-            f.write("Conversion Issues:\n")
-            for fname, issues in conversion_issues.items():
-                f.write(f"{fname}: {', '.join(issues)}\n")
-        
+        report_path = write_error_report(e, conversion_issues)
+        raise ConversionError(error_msg, report_path) from e
+    finally:
+        if history is not None:
+            history.close()
+        metrics.close()
+
+def heic_to_pdf_with_fallback(input_folder, output_pdf, compression_quality, supported_formats, 
+                            progress_bar, status_label, pdf_options=None, recursive=True, min_date=None, 
+                            skip_converted=True, delete_source=False, workers=None,
+                            hash_algorithm=HASH_ALGORITHM, shard_pages=None,
+                            shard_bytes=None, shard_by=None, write_manifest=True):
+    """Run convert_folder_to_pdf() reporting to tkinter widgets and dialogs."""
+    from tkinter import messagebox
+
+    def update_progress(done, total, message, bytes_done):
+        progress_bar["maximum"] = max(total, 1)
+        progress_bar["value"] = done
+        status_label.config(text=message)
+        progress_bar.update_idletasks()
+
+    def confirm_issues(conversion_issues):
+        issues_text = "\n".join(
+            f"{fname}: {', '.join(issues)}"
+            for fname, issues in conversion_issues.items()
+        )
+        return messagebox.askyesno("Potential Issues", 
+            f"The following issues were detected:\n\n{issues_text}\n\nContinue anyway?")
+
+    try:
+        result = convert_folder_to_pdf(
+            input_folder, output_pdf, compression_quality, supported_formats,
+            pdf_options=pdf_options, recursive=recursive, min_date=min_date,
+            skip_converted=skip_converted, delete_source=delete_source,
+            workers=workers, hash_algorithm=hash_algorithm,
+            progress_callback=update_progress, confirm_issues=confirm_issues,
+            shard_pages=shard_pages, shard_bytes=shard_bytes,
+            shard_by=shard_by, write_manifest=write_manifest
+        )
+        if result['status'] == 'no_files':
+            messagebox.showwarning("No Files", "No matching files found!")
+        elif result['status'] == 'up_to_date':
+            messagebox.showinfo("Info", "All files are up to date!")
+        elif result['status'] == 'converted':
+            messagebox.showinfo("Success", f"PDF created successfully: {result['output']}")
+    except ConversionError as e:
+        messagebox.showerror("Error", str(e))
         messagebox.showinfo("Error Report", 
-            f"An error report has been generated at:\n{report_path}")
+            f"An error report has been generated at:\n{e.report_path}")
     finally:
         progress_bar["value"] = 0
         status_label.config(text="Ready")
@@ -0,0 +1,117 @@
+import os
+import json
+import sqlite3
+import logging
+from datetime import datetime
+
+# SQLite database holding the conversion history
+HISTORY_DB = "conversion_history.db"
+# Pre-SQLite history file, imported once and then renamed
+LEGACY_HISTORY_FILE = "conversion_history.json"
+
+# SQLite caps the number of bound parameters per statement
+QUERY_BATCH_SIZE = 500
+
+class ConversionHistory:
+    """Conversion history stored in an indexed SQLite database."""
+    def __init__(self, db_path=HISTORY_DB, legacy_file=LEGACY_HISTORY_FILE):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.row_factory = sqlite3.Row
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "hash TEXT PRIMARY KEY, path TEXT NOT NULL, "
+                "timestamp REAL NOT NULL, output TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_history_path ON history(path)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_history_output ON history(output)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp)"
+            )
+        if legacy_file and os.path.exists(legacy_file):
+            self._migrate_json(legacy_file)
+
+    def _migrate_json(self, legacy_file):
+        """Import the old JSON history once, then move the file aside."""
+        try:
+            with open(legacy_file, 'r') as f:
+                legacy = json.load(f)
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO history (hash, path, timestamp, output) "
+                    "VALUES (?, ?, ?, ?)",
+                    [
+                        (file_hash, info['path'], info['timestamp'], info['output'])
+                        for file_hash, info in legacy.items()
+                    ]
+                )
+            os.replace(legacy_file, legacy_file + ".migrated")
+            logging.info(
+                f"Migrated {len(legacy)} history entries from {legacy_file}"
+            )
+        except Exception as e:
+            logging.error(f"Error migrating conversion history: {e}")
+
+    def get(self, file_hash):
+        """Return the history entry for a file hash, or None."""
+        row = self.conn.execute(
+            "SELECT hash, path, timestamp, output FROM history WHERE hash = ?",
+            (file_hash,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def get_timestamps(self, file_hashes):
+        """Return {hash: timestamp} for the hashes present in the history."""
+        file_hashes = list(file_hashes)
+        timestamps = {}
+        for start in range(0, len(file_hashes), QUERY_BATCH_SIZE):
+            batch = file_hashes[start:start + QUERY_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.conn.execute(
+                f"SELECT hash, timestamp FROM history WHERE hash IN ({placeholders})",
+                batch
+            )
+            timestamps.update((row['hash'], row['timestamp']) for row in rows)
+        return timestamps
+
+    def record(self, entries):
+        """Upsert (hash, path, output) entries stamped with the current time."""
+        timestamp = datetime.now().timestamp()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO history (hash, path, timestamp, output) "
+                "VALUES (?, ?, ?, ?) ON CONFLICT(hash) DO UPDATE SET "
+                "path = excluded.path, timestamp = excluded.timestamp, "
+                "output = excluded.output",
+                [
+                    (file_hash, path, timestamp, output)
+                    for file_hash, path, output in entries
+                ]
+            )
+
+    def count(self):
+        """Return the number of history entries."""
+        return self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def page(self, offset=0, limit=100):
+        """Return one page of entries, newest first."""
+        rows = self.conn.execute(
+            "SELECT hash, path, timestamp, output FROM history "
+            "ORDER BY timestamp DESC, hash LIMIT ? OFFSET ?",
+            (limit, offset)
+        )
+        return [dict(row) for row in rows]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
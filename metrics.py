@@ -0,0 +1,246 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Prefix of every metric in the Prometheus text export
+PROMETHEUS_PREFIX = "heic2pdf"
+
+# Order in which stages are listed in summaries
+STAGE_ORDER = (
+    "scan", "hash", "issue_check", "cloudconvert", "decode", "encode",
+    "embed", "write"
+)
+
+def get_peak_rss_mb():
+    """Return the peak RSS of this process and its children in MB."""
+    if resource is None:
+        return None
+    peak = (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    )
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(peak / divisor, 1)
+
+class ConversionMetrics:
+    """Per-stage timings, per-file records and byte counts for one run.
+
+    Every record is handed to the sinks as it is produced; a sink is any
+    object with emit(record) and close(summary) methods. Stage seconds add
+    up the time of each item, so stages run by parallel workers can total
+    more than the wall clock time.
+    """
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.stages = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.pages = 0
+        # Pages per PDF image encoding, for files recorded with a codec
+        self.codecs = {}
+        self.started = time.perf_counter()
+        self.final_summary = None
+
+    def add(self, stage, seconds, count=1, nbytes=0):
+        """Add time spent in a stage, over count items and nbytes bytes."""
+        totals = self.stages.setdefault(stage, {'seconds': 0.0, 'count': 0, 'bytes': 0})
+        totals['seconds'] += seconds
+        totals['count'] += count
+        totals['bytes'] += nbytes
+
+    @contextmanager
+    def stage(self, stage, count=1, nbytes=0):
+        """Time the enclosed block as one run of stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, count, nbytes)
+
+    def file(self, path, size, timings, output_bytes=None, pages=1, **fields):
+        """Record one converted file, the PDF pages it made and its stage times."""
+        for stage, seconds in timings.items():
+            self.add(stage, seconds, 1, size)
+        self.bytes_in += size
+        self.pages += pages
+        if fields.get('codec'):
+            self.codecs[fields['codec']] = self.codecs.get(fields['codec'], 0) + pages
+        self.emit({
+            'event': 'file', 'path': path, 'bytes_in': size,
+            'bytes_out': output_bytes, 'pages': pages,
+            'stages': {stage: round(seconds, 6) for stage, seconds in timings.items()},
+            **fields
+        })
+
+    def merge(self, other):
+        """Fold the stages and counts of metrics from another process in."""
+        for stage, totals in other['stages'].items():
+            self.add(stage, totals['seconds'], totals['count'], totals['bytes'])
+        self.bytes_in += other['bytes_in']
+        self.pages += other['pages']
+        for codec, count in other.get('codecs', {}).items():
+            self.codecs[codec] = self.codecs.get(codec, 0) + count
+        for record in other.get('records', []):
+            self.emit(record)
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink.emit(record)
+
+    def summary(self, **fields):
+        """Return the run totals as a dict."""
+        return {
+            'event': 'summary',
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'seconds': round(time.perf_counter() - self.started, 4),
+            'pages': self.pages,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'peak_rss_mb': get_peak_rss_mb(),
+            'codecs': dict(sorted(self.codecs.items())),
+            'stages': {
+                stage: {
+                    'seconds': round(totals['seconds'], 4),
+                    'count': totals['count'],
+                    'bytes': totals['bytes']
+                }
+                for stage, totals in sorted(
+                    self.stages.items(), key=lambda item: stage_rank(item[0])
+                )
+            },
+            **fields
+        }
+
+    def close(self, **fields):
+        """Send the summary to the sinks, close them and return the summary.
+
+        Only the first call does anything; later ones return the same summary.
+        """
+        if self.final_summary is None:
+            self.final_summary = self.summary(**fields)
+            for sink in self.sinks:
+                sink.close(self.final_summary)
+        return self.final_summary
+
+class RecordingMetrics(ConversionMetrics):
+    """Metrics that keep their records, to be merged by another process."""
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def export(self):
+        """Return what merge() needs, as picklable data."""
+        return {
+            'stages': self.stages, 'bytes_in': self.bytes_in,
+            'pages': self.pages, 'codecs': self.codecs,
+            'records': self.records
+        }
+
+def stage_rank(stage):
+    """Sort key listing known stages in pipeline order."""
+    return (STAGE_ORDER.index(stage), stage) if stage in STAGE_ORDER else (len(STAGE_ORDER), stage)
+
+def format_summary(summary):
+    """Return a one-line human readable summary."""
+    parts = [
+        f"{summary['pages']} pages in {summary['seconds']:.1f}s",
+        f"{summary['bytes_in'] / (1024 * 1024):.1f} MB in",
+        f"{summary['bytes_out'] / (1024 * 1024):.1f} MB out"
+    ]
+    stages = ", ".join(
+        f"{stage} {totals['seconds']:.1f}s"
+        for stage, totals in summary['stages'].items()
+    )
+    if stages:
+        parts.append(stages)
+    codecs = ", ".join(
+        f"{count} {codec}" for codec, count in summary.get('codecs', {}).items()
+    )
+    if codecs:
+        parts.append(f"pages: {codecs}")
+    if summary['peak_rss_mb'] is not None:
+        parts.append(f"peak {summary['peak_rss_mb']:.0f} MB")
+    return "; ".join(parts)
+
+class JsonLinesSink:
+    """Append each record as one JSON line to a file."""
+    def __init__(self, path):
+        self.f = open(path, 'a')
+
+    def emit(self, record):
+        self.f.write(json.dumps(record) + "\n")
+
+    def close(self, summary):
+        self.emit(summary)
+        self.f.close()
+
+class PrometheusTextSink:
+    """Write the run summary in the Prometheus text format.
+
+    The file is replaced atomically at the end of each run, as expected by
+    the node_exporter textfile collector.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, record):
+        pass
+
+    def close(self, summary):
+        prefix = PROMETHEUS_PREFIX
+        lines = [
+            f"# HELP {prefix}_stage_seconds Seconds spent per pipeline stage in the last run",
+            f"# TYPE {prefix}_stage_seconds gauge"
+        ]
+        lines += [
+            f'{prefix}_stage_seconds{{stage="{stage}"}} {totals["seconds"]}'
+            for stage, totals in summary['stages'].items()
+        ]
+        lines += [
+            f"# HELP {prefix}_stage_items Items processed per pipeline stage in the last run",
+            f"# TYPE {prefix}_stage_items gauge"
+        ]
+        lines += [
+            f'{prefix}_stage_items{{stage="{stage}"}} {totals["count"]}'
+            for stage, totals in summary['stages'].items()
+        ]
+        if summary.get('codecs'):
+            lines += [
+                f"# HELP {prefix}_codec_pages Pages per PDF image encoding in the last run",
+                f"# TYPE {prefix}_codec_pages gauge"
+            ]
+            lines += [
+                f'{prefix}_codec_pages{{codec="{codec}"}} {count}'
+                for codec, count in summary['codecs'].items()
+            ]
+        for name, value, help_text in (
+            ("pages", summary['pages'], "Pages converted in the last run"),
+            ("run_seconds", summary['seconds'], "Duration of the last run"),
+            ("bytes_in", summary['bytes_in'], "Source image bytes read in the last run"),
+            ("bytes_out", summary['bytes_out'], "PDF bytes written in the last run"),
+            ("peak_rss_megabytes", summary['peak_rss_mb'], "Peak resident memory of the last run"),
+            ("last_run_timestamp_seconds", round(time.time()), "When the last run finished")
+        ):
+            if value is None:
+                continue
+            lines += [
+                f"# HELP {prefix}_{name} {help_text}",
+                f"# TYPE {prefix}_{name} gauge",
+                f"{prefix}_{name} {value}"
+            ]
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, self.path)
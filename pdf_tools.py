@@ -0,0 +1,529 @@
+import os
+from io import BytesIO
+
+from PyPDF2 import PdfReader
+from PyPDF2.generic import (
+    ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject,
+    NameObject, NumberObject, StreamObject
+)
+
+# Bytes read from the end of a PDF to find its last startxref
+TAIL_BYTES = 2048
+# Catalog entries that live outside the pages and are not copied page by
+# page: bookmarks, named destinations and interactive forms
+DOCUMENT_ENTRIES = ("/Outlines", "/Names", "/Dests", "/AcroForm")
+# Resource names of the forms drawn under and over layered pages
+UNDER_LAYER = "/Backdrop"
+OVER_LAYER = "/Overlay"
+
+def find_startxref(f):
+    """Return the offset recorded by the last startxref keyword of a PDF file."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(max(0, size - TAIL_BYTES))
+    tail = f.read()
+    pos = tail.rfind(b"startxref")
+    if pos < 0:
+        raise ValueError("startxref not found")
+    return int(tail[pos + len(b"startxref"):].split()[0])
+
+def uses_xref_table(f, startxref):
+    """Check whether the last cross-reference section is a classic xref table."""
+    f.seek(startxref)
+    return f.read(4) == b"xref"
+
+def reference_key(page):
+    """Return the (idnum, generation) of a page read by PdfReader."""
+    return page.indirect_reference.idnum, page.indirect_reference.generation
+
+def open_source(source):
+    """Return a binary file for a PDF given as bytes or a path."""
+    if isinstance(source, (bytes, bytearray)):
+        return BytesIO(source)
+    # An open file keeps PdfReader from loading it all in memory
+    return open(source, 'rb')
+
+def has_document_structure(reader):
+    """Check whether a PDF has bookmarks, named destinations or a form."""
+    catalog = reader.trailer["/Root"].get_object()
+    for name in DOCUMENT_ENTRIES:
+        if name not in catalog:
+            continue
+        # fpdf and others write an empty outline root
+        if name == "/Outlines" and "/First" not in catalog[name].get_object():
+            continue
+        return True
+    return False
+
+def is_page_tree_node(obj):
+    """Check whether a dictionary is a page or an intermediate page tree node."""
+    return obj.get("/Type") in ("/Page", "/Pages")
+
+def collect_objects(pages, skip=(), roots=()):
+    """Return the indirect objects reachable from pages, the page tree excluded.
+
+    The result maps (idnum, generation) to the resolved object, starting
+    with the pages themselves; objects whose key is in skip are neither
+    returned nor followed. roots are further objects or references to
+    start from. The /Parent of pages is not followed, while
+    that of annotations and form fields is. Pages are taken as PdfReader
+    flattened them, with inherited attributes such as /Resources and
+    /MediaBox copied in.
+    """
+    found = {reference_key(page): page for page in pages}
+    stack = list(found.values()) + list(roots)
+    while stack:
+        item = stack.pop()
+        if isinstance(item, IndirectObject):
+            key = (item.idnum, item.generation)
+            if key in found or key in skip:
+                continue
+            obj = item.get_object()
+            found[key] = obj
+            stack.append(obj)
+        elif isinstance(item, dict):
+            stack.extend(
+                value for name, value in item.items()
+                if name != "/Parent" or not is_page_tree_node(item)
+            )
+        elif isinstance(item, list):
+            stack.extend(item)
+    return found
+
+def renumber(obj, numbers):
+    """Return a copy of obj with indirect references renumbered."""
+    if isinstance(obj, IndirectObject):
+        return IndirectObject(numbers[(obj.idnum, obj.generation)], 0, None)
+    if isinstance(obj, StreamObject):
+        copy = obj.__class__()
+        copy._data = obj._data
+        copy.update(
+            (name, renumber(value, numbers))
+            for name, value in obj.items() if name != "/Parent"
+        )
+        return copy
+    if isinstance(obj, DictionaryObject):
+        # Page parents point into the source page tree; callers set their
+        # own. Annotations and form fields keep theirs.
+        return DictionaryObject(
+            (name, renumber(value, numbers))
+            for name, value in obj.items()
+            if name != "/Parent" or not is_page_tree_node(obj)
+        )
+    if isinstance(obj, ArrayObject):
+        return ArrayObject(renumber(value, numbers) for value in obj)
+    return obj
+
+def write_object(stream, idnum, generation, obj):
+    """Serialize one indirect object."""
+    stream.write(f"{idnum} {generation} obj\n".encode())
+    obj.write_to_stream(stream, None)
+    stream.write(b"\nendobj\n")
+
+def write_xref(stream, offsets):
+    """Write an xref table for {idnum: (offset, generation)}."""
+    stream.write(b"xref\n")
+    # Object 0 heads the free list; listing it keeps strict readers happy
+    offsets = dict(offsets)
+    offsets[0] = (0, 65535)
+    numbers = sorted(offsets)
+    start = 0
+    while start < len(numbers):
+        # Group consecutive object numbers into one subsection
+        end = start + 1
+        while end < len(numbers) and numbers[end] == numbers[end - 1] + 1:
+            end += 1
+        stream.write(f"{numbers[start]} {end - start}\n".encode())
+        for idnum in numbers[start:end]:
+            offset, generation = offsets[idnum]
+            kind = "f" if idnum == 0 else "n"
+            stream.write(f"{offset:010d} {generation:05d} {kind}\r\n".encode())
+        start = end
+
+def page_content_data(page):
+    """Return the decoded content stream of a page read by PdfReader."""
+    contents = page["/Contents"]
+    if isinstance(contents, list):
+        return b"\n".join(part.get_object().get_data() for part in contents)
+    return contents.get_data()
+
+def content_stream(data):
+    """Return a Flate-compressed stream object holding data."""
+    stream = DecodedStreamObject()
+    stream._data = data
+    return stream.flate_encode()
+
+def flatten_name_tree(node):
+    """Return the (name, value) pairs of a PDF name tree, in order."""
+    node = node.get_object()
+    pairs = []
+    if "/Names" in node:
+        names = node["/Names"].get_object()
+        pairs.extend(zip(names[::2], names[1::2]))
+    for kid in node.get("/Kids", ()):
+        pairs.extend(flatten_name_tree(kid))
+    return pairs
+
+class PdfStreamWriter:
+    """Write a PDF page by page, copying the pages of other PDFs into it.
+
+    Every object is written as soon as it is copied, so memory stays
+    bounded by the largest page rather than the whole document. A new file
+    is written under a temporary name and moved to output_path by close().
+    With append=True the pages go after those already in output_path, as
+    an incremental update that leaves the existing bytes alone; ValueError
+    is raised when output_path cannot be updated in place (encrypted, or
+    using cross-reference streams). abort() drops everything written.
+    """
+    def __init__(self, output_path, append=False):
+        self.output_path = output_path
+        self.offsets = {}
+        self.kids = []
+        # Pages added so far
+        self.pages = 0
+        self.info_ref = None
+        # Bookmarks: the shared root, the first top-level item and the last
+        # one, which waits for its /Next until the next document is read
+        self.outline_number = None
+        self.outline_first = None
+        self.outline_last = None
+        self.outline_count = 0
+        self.name_trees = {}
+        self.dests = DictionaryObject()
+        self.form = None
+        self.fields = ArrayObject()
+        self.update = None
+        self.closed = False
+        if append:
+            self.start_update()
+            return
+        # Object 1 is the page tree root and 2 the catalog, written last
+        self.pages_ref = IndirectObject(1, 0, None)
+        self.next_number = 3
+        self.path = output_path + ".tmp"
+        self.out = open(self.path, 'wb')
+        self.out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+
+    def start_update(self):
+        """Read what an incremental update of output_path needs and open it."""
+        with open(self.output_path, 'rb') as f:
+            startxref = find_startxref(f)
+            if not uses_xref_table(f, startxref):
+                raise ValueError(f"{self.output_path} uses cross-reference streams")
+            f.seek(0)
+            target = PdfReader(f)
+            if target.is_encrypted:
+                raise ValueError(f"{self.output_path} is encrypted")
+            trailer = target.trailer
+            self.pages_ref = trailer["/Root"].get_object().raw_get("/Pages")
+            self.pages_root = DictionaryObject(self.pages_ref.get_object())
+            self.kids = list(self.pages_root["/Kids"].get_object())
+            self.next_number = trailer["/Size"]
+            self.update = DictionaryObject()
+            for name in ("/Root", "/Info", "/ID"):
+                if name in trailer:
+                    self.update[NameObject(name)] = trailer.raw_get(name)
+            self.update[NameObject("/Prev")] = NumberObject(startxref)
+        self.path = self.output_path
+        self.out = open(self.path, 'r+b')
+        self.size_before = self.out.seek(0, os.SEEK_END)
+        self.out.seek(-1, os.SEEK_END)
+        if self.out.read(1) not in (b"\n", b"\r"):
+            self.out.write(b"\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, number, obj):
+        """Write obj as indirect object number."""
+        self.offsets[number] = (self.out.tell(), 0)
+        write_object(self.out, number, 0, obj)
+
+    def number(self, objects, numbers):
+        """Give the objects without a number in numbers the next free ones."""
+        for key in objects:
+            if key not in numbers:
+                numbers[key] = self.next_number
+                self.next_number += 1
+
+    def copy(self, items, numbers):
+        """Write what items use that is not written yet; return them renumbered."""
+        objects = collect_objects([], skip=numbers, roots=items)
+        self.number(objects, numbers)
+        for key, obj in objects.items():
+            self.write(numbers[key], renumber(obj, numbers))
+        return [renumber(item, numbers) for item in items]
+
+    def add_form(self, source):
+        """Write the first page of a PDF as a form XObject; return its reference."""
+        with open_source(source) as f:
+            page = PdfReader(f).pages[0]
+            form = content_stream(page_content_data(page))
+            form.update({
+                NameObject("/Type"): NameObject("/XObject"),
+                NameObject("/Subtype"): NameObject("/Form"),
+                NameObject("/BBox"): ArrayObject(page.mediabox),
+                NameObject("/Resources"): self.copy([page["/Resources"]], {})[0]
+            })
+        form_ref = IndirectObject(self.next_number, 0, None)
+        self.write(self.next_number, form)
+        self.next_number += 1
+        return form_ref
+
+    def add_layers(self, under=None, over=None):
+        """Prepare pages drawn on top of one PDF page and under another.
+
+        under and over are one-page PDFs (paths or bytes, either may be
+        None) the size of the pages they go with. Each is written once, as
+        a form XObject, along with the two content streams that draw them;
+        pass the returned layers to add_document() and every page it adds
+        only refers to those objects. Returns None when both are None.
+        """
+        if under is None and over is None:
+            return None
+        forms = DictionaryObject()
+        before, after = b"q\n", b"Q\n"
+        if under is not None:
+            forms[NameObject(UNDER_LAYER)] = self.add_form(under)
+            before = f"q {UNDER_LAYER} Do Q\n".encode() + before
+        if over is not None:
+            forms[NameObject(OVER_LAYER)] = self.add_form(over)
+            after += f"q {OVER_LAYER} Do Q\n".encode()
+        streams = []
+        for data in (before, after):
+            streams.append(IndirectObject(self.next_number, 0, None))
+            self.write(self.next_number, content_stream(data))
+            self.next_number += 1
+        return forms, streams
+
+    def add_document(self, source, layers=None):
+        """Copy every page of a PDF (a path or bytes) and return how many.
+
+        Bookmarks are chained one document after the other, named
+        destinations and other name trees are combined (the first document
+        wins a name), form fields are gathered into one form and the
+        document information of the first document is kept. An incremental
+        update cannot carry those over and raises ValueError instead.
+        With layers from add_layers(), every page is drawn between them;
+        its own content is wrapped in q/Q so the overlay sees a clean
+        graphics state.
+        """
+        with open_source(source) as f:
+            reader = PdfReader(f)
+            if self.update is not None and has_document_structure(reader):
+                raise ValueError("the appended PDF has bookmarks, destinations or a form")
+            catalog = reader.trailer["/Root"].get_object()
+            if self.update is None and self.info_ref is None and "/Info" in reader.trailer:
+                # Info values are plain strings and dates
+                info = DictionaryObject(
+                    (name, value.get_object())
+                    for name, value in reader.trailer["/Info"].get_object().items()
+                )
+                self.info_ref = IndirectObject(self.next_number, 0, None)
+                self.write(self.next_number, info)
+                self.next_number += 1
+            pages = reader.pages
+            # Number every page first so links between pages resolve
+            numbers = {}
+            self.number([reference_key(page) for page in pages], numbers)
+
+            # Top-level bookmarks hang off the shared outline root
+            outline_ref = catalog.raw_get("/Outlines") if "/Outlines" in catalog else None
+            outline = outline_ref.get_object() if outline_ref is not None else None
+            if outline is not None and "/First" in outline:
+                if self.outline_number is None:
+                    self.outline_number = self.next_number
+                    self.next_number += 1
+                numbers[(outline_ref.idnum, outline_ref.generation)] = self.outline_number
+
+            for page in pages:
+                if layers is not None:
+                    # Direct copies, so adding the forms changes this page only
+                    resources = DictionaryObject(page["/Resources"])
+                    resources[NameObject("/XObject")] = DictionaryObject(
+                        resources.get("/XObject", {})
+                    )
+                    page[NameObject("/Resources")] = resources
+                    if isinstance(page["/Contents"], list):
+                        page[NameObject("/Contents")] = ArrayObject(page["/Contents"])
+                objects = collect_objects([page], skip=numbers)
+                self.number(objects, numbers)
+                for key, obj in objects.items():
+                    obj = renumber(obj, numbers)
+                    if key == reference_key(page):
+                        obj[NameObject("/Parent")] = self.pages_ref
+                        if layers is not None:
+                            forms, (before, after) = layers
+                            obj["/Resources"]["/XObject"].update(forms)
+                            contents = obj.raw_get("/Contents")
+                            if not isinstance(contents, ArrayObject):
+                                contents = [contents]
+                            obj[NameObject("/Contents")] = ArrayObject(
+                                [before, *contents, after]
+                            )
+                        self.kids.append(IndirectObject(numbers[key], 0, None))
+                    self.write(numbers[key], obj)
+                # Everything this page used is written; let it go
+                reader.resolved_objects.clear()
+            self.pages += len(pages)
+
+            if outline is not None and "/First" in outline:
+                self.copy_outline(outline, numbers)
+            if "/Names" in catalog:
+                for tree, node in catalog["/Names"].get_object().items():
+                    entries = self.name_trees.setdefault(tree, {})
+                    for name, value in flatten_name_tree(node):
+                        if name.original_bytes not in entries:
+                            entries[name.original_bytes] = (name, self.copy([value], numbers)[0])
+            if "/Dests" in catalog:
+                for name, value in catalog["/Dests"].get_object().items():
+                    if name not in self.dests:
+                        self.dests[name] = self.copy([value], numbers)[0]
+            if "/AcroForm" in catalog:
+                acro_form = catalog["/AcroForm"].get_object()
+                # Fields used by widgets on the pages are written already
+                self.fields.extend(self.copy(list(acro_form.get("/Fields", [])), numbers))
+                if self.form is None:
+                    # Form-wide settings (default font, appearances) of the first form
+                    self.form = DictionaryObject(
+                        (name, self.copy([value], numbers)[0])
+                        for name, value in acro_form.items() if name != "/Fields"
+                    )
+            reader.resolved_objects.clear()
+        return len(pages)
+
+    def copy_outline(self, outline, numbers):
+        """Write a document's bookmarks, chained after those written before."""
+        first = outline.raw_get("/First")
+        last = outline.raw_get("/Last")
+        objects = collect_objects([], skip=numbers, roots=[first])
+        self.number(objects, numbers)
+        for key, obj in objects.items():
+            obj = renumber(obj, numbers)
+            if key == (first.idnum, first.generation):
+                if self.outline_last is None:
+                    self.outline_first = numbers[key]
+                else:
+                    # Chain this document's bookmarks after the last one's
+                    last_number, last_obj = self.outline_last
+                    obj[NameObject("/Prev")] = IndirectObject(last_number, 0, None)
+                    last_obj[NameObject("/Next")] = IndirectObject(numbers[key], 0, None)
+                    self.write(last_number, last_obj)
+            if key == (last.idnum, last.generation):
+                self.outline_last = (numbers[key], obj)
+                continue
+            self.write(numbers[key], obj)
+        self.outline_count += abs(outline.get("/Count", 0))
+
+    def close(self):
+        """Write the page tree, catalog and cross-reference table."""
+        if self.update is not None:
+            trailer = self.update
+            pages_root = self.pages_root
+            pages_root[NameObject("/Kids")] = ArrayObject(self.kids)
+            pages_root[NameObject("/Count")] = NumberObject(
+                pages_root["/Count"] + self.pages
+            )
+            self.offsets[self.pages_ref.idnum] = (self.out.tell(), self.pages_ref.generation)
+            write_object(self.out, self.pages_ref.idnum, self.pages_ref.generation, pages_root)
+        else:
+            trailer = DictionaryObject({NameObject("/Root"): IndirectObject(2, 0, None)})
+            if self.info_ref is not None:
+                trailer[NameObject("/Info")] = self.info_ref
+            self.write(1, DictionaryObject({
+                NameObject("/Type"): NameObject("/Pages"),
+                NameObject("/Kids"): ArrayObject(self.kids),
+                NameObject("/Count"): NumberObject(len(self.kids))
+            }))
+            self.write(2, self.catalog())
+        trailer[NameObject("/Size")] = NumberObject(self.next_number)
+
+        xref_offset = self.out.tell()
+        write_xref(self.out, self.offsets)
+        self.out.write(b"trailer\n")
+        trailer.write_to_stream(self.out, None)
+        self.out.write(f"\nstartxref\n{xref_offset}\n%%EOF\n".encode())
+        self.out.close()
+        if self.path != self.output_path:
+            os.replace(self.path, self.output_path)
+        self.closed = True
+
+    def catalog(self):
+        """Write the document-wide objects and return the catalog."""
+        catalog = DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): self.pages_ref
+        })
+        if self.outline_last is not None:
+            self.write(*self.outline_last)
+            self.write(self.outline_number, DictionaryObject({
+                NameObject("/Type"): NameObject("/Outlines"),
+                NameObject("/First"): IndirectObject(self.outline_first, 0, None),
+                NameObject("/Last"): IndirectObject(self.outline_last[0], 0, None),
+                NameObject("/Count"): NumberObject(self.outline_count)
+            }))
+            catalog[NameObject("/Outlines")] = IndirectObject(self.outline_number, 0, None)
+        if self.name_trees:
+            names = DictionaryObject()
+            for tree, entries in self.name_trees.items():
+                # One leaf holding every name, sorted as name trees must be
+                node = ArrayObject()
+                for key in sorted(entries):
+                    node.extend(entries[key])
+                names[tree] = IndirectObject(self.next_number, 0, None)
+                self.write(self.next_number, DictionaryObject({NameObject("/Names"): node}))
+                self.next_number += 1
+            catalog[NameObject("/Names")] = names
+        if self.dests:
+            catalog[NameObject("/Dests")] = IndirectObject(self.next_number, 0, None)
+            self.write(self.next_number, self.dests)
+            self.next_number += 1
+        if self.form is not None:
+            self.form[NameObject("/Fields")] = self.fields
+            catalog[NameObject("/AcroForm")] = IndirectObject(self.next_number, 0, None)
+            self.write(self.next_number, self.form)
+            self.next_number += 1
+        return catalog
+
+    def abort(self):
+        """Drop everything written, leaving output_path as it was."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.update is not None:
+            self.out.truncate(self.size_before)
+            self.out.close()
+        else:
+            self.out.close()
+            os.remove(self.path)
+
+def append_pages(target_path, new_pdf):
+    """Append the pages of new_pdf to target_path as an incremental update.
+
+    new_pdf is the PDF to take pages from, as bytes or a path. Only the new
+    page objects, an updated page tree root and a new xref section are
+    written at the end of target_path; the existing bytes are left alone.
+    Returns the number of pages appended. Raises ValueError when
+    target_path cannot be updated in place (encrypted, or using
+    cross-reference streams) or when new_pdf has bookmarks, named
+    destinations or a form, which only merge_documents() carries over.
+    """
+    with PdfStreamWriter(target_path, append=True) as writer:
+        return writer.add_document(new_pdf)
+
+def merge_documents(inputs, output_path):
+    """Write the pages of every input PDF, in order, into output_path.
+
+    inputs are paths or PDF bytes, copied by PdfStreamWriter.add_document().
+    Returns the number of pages written.
+    """
+    with PdfStreamWriter(output_path) as writer:
+        for source in inputs:
+            writer.add_document(source)
+    return writer.pages
@@ -0,0 +1,322 @@
+import zlib
+import struct
+from io import BytesIO
+
+from PIL import Image, TiffImagePlugin, TiffTags
+
+# Images decoded whole are refused over this many pixels, the size at
+# which Pillow's own default limit raises DecompressionBombError
+WHOLE_DECODE_MAX_PIXELS = 2 * (1024 * 1024 * 1024 // 4 // 3)
+# Compressed bytes read from a PNG file at a time
+PNG_READ_SIZE = 1024 * 1024
+# Filtered PNG bytes decoded at a time
+PNG_BAND_BYTES = 4 * 1024 * 1024
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Raw row layouts of the PNG (bit depth, color type) pairs read in strips,
+# as Pillow rawmodes; the others (2 and 4-bit gray, 16-bit color) are
+# decoded whole
+PNG_ROW_MODES = {
+    (1, 0): "1", (8, 0): "L", (16, 0): "I;16B", (8, 2): "RGB",
+    (1, 3): "P;1", (2, 3): "P;2", (4, 3): "P;4", (8, 3): "P",
+    (8, 4): "LA", (8, 6): "RGBA"
+}
+# TIFF tags copied into the small files that stripped TIFFs are read
+# through; everything needed to decode the strips and nothing that points
+# elsewhere in the source file
+TIFF_STRIP_TAGS = (
+    256, 258, 259, 262, 266, 277, 278, 284, 317, 320, 338, 339, 347,
+    529, 530, 531, 532
+)
+
+def check_whole_decode(image):
+    """Raise DecompressionBombError if an image is too big to decode whole."""
+    pixels = image.width * image.height
+    if pixels > WHOLE_DECODE_MAX_PIXELS:
+        raise Image.DecompressionBombError(
+            f"Image size ({pixels} pixels) exceeds limit of "
+            f"{WHOLE_DECODE_MAX_PIXELS} pixels for images decoded whole"
+        )
+
+class RawRows:
+    """Rows of an image stored uncompressed in full-width bands.
+
+    Covers BMP, uncompressed TIFF and PPM: each requested band is read
+    from the file with one seek and unpacked with Image.frombytes().
+    """
+    def __init__(self, image, file_path):
+        self.image = image
+        self.f = open(file_path, 'rb')
+        self.bands = [
+            (y0, y1, offset) + raw_layout(image, args)
+            for _, (_, y0, _, y1), offset, args in image.tile
+        ]
+
+    @staticmethod
+    def supports(image):
+        return bool(image.tile) and all(
+            tile[0] == "raw" and tile[1][0] == 0 and tile[1][2] == image.width
+            and raw_layout(image, tile[3]) is not None
+            for tile in image.tile
+        )
+
+    def read(self, top, bottom):
+        image = self.image
+        rows = Image.new(image.mode, (image.width, bottom - top))
+        for y0, y1, offset, rawmode, stride, orientation in self.bands:
+            first, last = max(top, y0), min(bottom, y1)
+            if first >= last:
+                continue
+            # Bottom-up bands store their last row first
+            start = y1 - last if orientation < 0 else first - y0
+            self.f.seek(offset + start * stride)
+            band = Image.frombytes(
+                image.mode, (image.width, last - first),
+                self.f.read((last - first) * stride), "raw", rawmode, stride,
+                orientation
+            )
+            rows.paste(band, (0, first - top))
+        if image.palette is not None:
+            rows.putpalette(image.palette)
+        rows.info = dict(image.info)
+        return rows
+
+    def close(self):
+        self.f.close()
+
+def raw_layout(image, args):
+    """Return (rawmode, stride, orientation) of a raw tile, or None.
+
+    A stride of 0 in the tile means packed rows; the stride is then worked
+    out by packing one row, which fails for rawmodes Pillow only unpacks.
+    """
+    if isinstance(args, str):
+        args = (args, 0, 1)
+    if not isinstance(args, tuple) or len(args) != 3:
+        return None
+    rawmode, stride, orientation = args
+    if stride <= 0:
+        try:
+            stride = len(Image.new(image.mode, (image.width, 1)).tobytes("raw", rawmode))
+        except ValueError:
+            return None
+    return rawmode, stride, orientation
+
+class PngRows:
+    """Rows of a non-interlaced PNG, inflated in order as they are asked for.
+
+    The image data is inflated with zlib up to the last row needed, and
+    the still filtered rows are decoded by Pillow as a small PNG of their
+    own, led by the unfiltered row above them that the filters refer to.
+    Bands must be asked for top to bottom; they may overlap the previous
+    band, whose rows are kept.
+    """
+    def __init__(self, image, file_path):
+        self.image = image
+        self.f = open(file_path, 'rb')
+        self.f.seek(len(PNG_SIGNATURE))
+        self.chunks = b""
+        self.idat = []
+        while True:
+            length, tag = struct.unpack(">I4s", self.f.read(8))
+            if tag == b"IHDR":
+                header = self.f.read(length)
+                self.f.seek(4, 1)
+            elif tag in (b"PLTE", b"tRNS"):
+                data = self.f.read(length)
+                self.f.seek(4, 1)
+                self.chunks += png_chunk(tag, data)
+            elif tag == b"IDAT":
+                self.idat.append((self.f.tell(), length))
+                self.f.seek(length + 4, 1)
+            elif tag == b"IEND":
+                break
+            else:
+                self.f.seek(length + 4, 1)
+        width, bit_depth, color_type = struct.unpack(">I4xBB", header[:10])
+        self.header = header
+        self.rawmode = PNG_ROW_MODES[bit_depth, color_type]
+        channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+        self.row_bytes = 1 + (width * channels * bit_depth + 7) // 8
+        self.inflater = zlib.decompressobj()
+        self.pending = self.iter_idat()
+        self.previous = None
+        self.next_row = 0
+        self.kept = None
+        self.kept_top = 0
+
+    @staticmethod
+    def supports(image, file_path):
+        if image.format != "PNG":
+            return False
+        with open(file_path, 'rb') as f:
+            head = f.read(len(PNG_SIGNATURE) + 25)
+        bit_depth, color_type, _, _, interlace = head[24:29]
+        return interlace == 0 and (bit_depth, color_type) in PNG_ROW_MODES
+
+    def iter_idat(self):
+        """Yield the compressed image data, a piece at a time."""
+        for offset, length in self.idat:
+            self.f.seek(offset)
+            while length > 0:
+                data = self.f.read(min(length, PNG_READ_SIZE))
+                length -= len(data)
+                yield data
+
+    def inflate(self, size):
+        """Return the next size bytes of filtered rows."""
+        data = bytearray()
+        while len(data) < size:
+            if self.inflater.unconsumed_tail:
+                compressed = self.inflater.unconsumed_tail
+            else:
+                compressed = next(self.pending, b"")
+                if not compressed:
+                    raise ValueError("PNG image data ends early")
+            data += self.inflater.decompress(compressed, size - len(data))
+        return bytes(data)
+
+    def decode(self, count):
+        """Decode the next count rows into an image."""
+        rows = self.inflate(count * self.row_bytes)
+        if self.previous is not None:
+            # Filter type 0 leaves the row above as it is
+            rows = b"\0" + self.previous + rows
+        width = self.image.width
+        height = count + (self.previous is not None)
+        header = struct.pack(">II", width, height) + self.header[8:]
+        data = (
+            PNG_SIGNATURE + png_chunk(b"IHDR", header) + self.chunks
+            + png_chunk(b"IDAT", zlib.compress(rows, 0)) + png_chunk(b"IEND", b"")
+        )
+        with Image.open(BytesIO(data)) as band:
+            band.load()
+            if self.previous is not None:
+                band = band.crop((0, 1, width, height))
+        self.previous = band.crop((0, count - 1, width, count)).tobytes("raw", self.rawmode)
+        return band
+
+    def read(self, top, bottom):
+        if top < self.kept_top:
+            raise ValueError("PNG rows must be read top to bottom")
+        width = self.image.width
+        if bottom > self.next_row:
+            rows = None
+            while self.next_row < bottom:
+                count = min(bottom - self.next_row, max(1, PNG_BAND_BYTES // self.row_bytes))
+                band = self.decode(count)
+                if rows is None:
+                    rows = Image.new(band.mode, (width, bottom - top))
+                    if top < self.next_row:
+                        # Keep the overlap with the band read before
+                        rows.paste(self.kept.crop(
+                            (0, top - self.kept_top, width, self.next_row - self.kept_top)
+                        ))
+                    if band.mode == "P":
+                        rows.putpalette(band.palette)
+                    rows.info = band.info
+                if self.next_row + count > top:
+                    skip = max(0, top - self.next_row)
+                    rows.paste(
+                        band.crop((0, skip, width, count)),
+                        (0, self.next_row + skip - top)
+                    )
+                self.next_row += count
+            self.kept, self.kept_top = rows, top
+        return self.kept.crop(
+            (0, top - self.kept_top, width, bottom - self.kept_top)
+        )
+
+    def close(self):
+        self.f.close()
+
+def png_chunk(tag, data):
+    """Return a PNG chunk with its length and CRC."""
+    return (
+        struct.pack(">I", len(data)) + tag + data
+        + struct.pack(">I", zlib.crc32(tag + data))
+    )
+
+class TiffRows:
+    """Rows of a compressed TIFF stored in strips.
+
+    The strips covering a band are copied into a small TIFF of their own,
+    which Pillow decodes with the source's compression settings.
+    """
+    def __init__(self, image, file_path):
+        self.image = image
+        self.f = open(file_path, 'rb')
+        tags = image.tag_v2
+        self.offsets = tags[273]
+        self.counts = tags[279]
+        self.rows_per_strip = min(tags.get(278, image.height), image.height)
+
+    @staticmethod
+    def supports(image):
+        if image.format != "TIFF":
+            return False
+        tags = image.tag_v2
+        return (
+            273 in tags and 279 in tags and 322 not in tags
+            and tags.get(284, 1) == 1 and tags.get(259, 1) != 1
+        )
+
+    def read(self, top, bottom):
+        image = self.image
+        first = top // self.rows_per_strip
+        last = (bottom - 1) // self.rows_per_strip + 1
+        band_top = first * self.rows_per_strip
+        band_rows = min(last * self.rows_per_strip, image.height) - band_top
+
+        ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=b"II")
+        for tag in TIFF_STRIP_TAGS:
+            if tag in image.tag_v2:
+                ifd[tag] = image.tag_v2[tag]
+                ifd.tagtype[tag] = image.tag_v2.tagtype[tag]
+        ifd[257] = band_rows
+        counts = self.counts[first:last]
+        ifd[279] = counts
+        ifd.tagtype[279] = TiffTags.LONG
+        # tobytes() moves the strip offsets past the IFD it writes
+        ifd[273] = [sum(counts[:i]) for i in range(len(counts))]
+        ifd.tagtype[273] = TiffTags.LONG
+
+        strips = bytearray()
+        for offset, count in zip(self.offsets[first:last], counts):
+            self.f.seek(offset)
+            strips += self.f.read(count)
+        data = b"II*\0" + struct.pack("<I", 8) + ifd.tobytes(8) + strips
+        with Image.open(BytesIO(data)) as band:
+            band.load()
+            return band.crop((0, top - band_top, image.width, bottom - band_top))
+
+    def close(self):
+        self.f.close()
+
+class DecodedRows:
+    """Rows of an image decoded whole on the first read."""
+    def __init__(self, image):
+        check_whole_decode(image)
+        self.image = image
+
+    def read(self, top, bottom):
+        return self.image.crop((0, top, self.image.width, bottom))
+
+    def close(self):
+        pass
+
+def open_rows(image, file_path):
+    """Return a reader giving bands of rows of an opened image.
+
+    The reader's read(top, bottom) returns rows top to bottom as a loaded
+    image, and close() releases the file. Uncompressed images (BMP, TIFF,
+    PPM), non-interlaced PNGs and compressed TIFFs in strips are read a
+    band at a time; anything else (JPEG, GIF, interlaced PNG) is decoded
+    whole on the first read.
+    """
+    if RawRows.supports(image):
+        return RawRows(image, file_path)
+    if PngRows.supports(image, file_path):
+        return PngRows(image, file_path)
+    if TiffRows.supports(image):
+        return TiffRows(image, file_path)
+    return DecodedRows(image)
@@ -0,0 +1,202 @@
+import json
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import fallback_handler
+from fallback_handler import CloudConvertClient, convert_heic_batch_with_cloudconvert
+
+API_KEY = "test-key"
+# Polls answered "processing" before a job reports "finished"
+POLLS_BEFORE_FINISHED = 4
+# Bytes of each converted file, several download chunks long
+CONVERTED_BYTES = 3 * fallback_handler.HASH_CHUNK_SIZE + 123
+
+def converted_data(uploaded):
+    """Return the "JPEG" the stand-in server makes of an uploaded file."""
+    return (b"JPEG" + uploaded) * (CONVERTED_BYTES // (len(uploaded) + 4) + 1)
+
+class CloudConvertStandIn(ThreadingHTTPServer):
+    """A local server answering the CloudConvert calls the client makes."""
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), CloudConvertHandler)
+        self.url = f"http://127.0.0.1:{self.server_address[1]}"
+        self.lock = threading.Lock()
+        # Task dicts sent to POST /jobs, one per job
+        self.jobs = []
+        self.polls = {}
+        # (job, index) -> (form fields, file name, file data)
+        self.uploads = {}
+        # (method, path, Authorization header) of every request
+        self.requests = []
+
+class CloudConvertHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def record(self):
+        with self.server.lock:
+            self.server.requests.append(
+                (self.command, self.path, self.headers.get("Authorization"))
+            )
+
+    def do_POST(self):
+        self.record()
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        parts = self.path.strip("/").split("/")
+        if parts == ["jobs"]:
+            tasks = json.loads(body)["tasks"]
+            with self.server.lock:
+                job = len(self.server.jobs)
+                self.server.jobs.append(tasks)
+            # The API lists tasks rather than keying them by name
+            self.send_json({"data": {"id": f"job-{job}", "status": "waiting", "tasks": [
+                {"name": name, "operation": task["operation"], "result": {"form": {
+                    "url": f"{self.server.url}/upload/{job}/{name.split('-')[1]}",
+                    "parameters": {"expires": "3600", "signature": f"sig-{name}"}
+                }}} if task["operation"] == "import/upload" else
+                {"name": name, "operation": task["operation"]}
+                for name, task in tasks.items()
+            ]}}, status=201)
+        elif parts[0] == "upload":
+            message = BytesParser(policy=HTTP).parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            fields, upload = {}, None
+            for part in message.iter_parts():
+                name = part.get_param("name", header="content-disposition")
+                if part.get_filename() is not None:
+                    upload = (name, part.get_payload(decode=True))
+                else:
+                    fields[name] = part.get_content()
+            with self.server.lock:
+                self.server.uploads[int(parts[1]), int(parts[2])] = (fields, *upload)
+            self.send_response(201)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_error(404)
+
+    def do_GET(self):
+        self.record()
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "jobs":
+            job = int(parts[1].split("-")[1])
+            with self.server.lock:
+                polls = self.server.polls[job] = self.server.polls.get(job, 0) + 1
+                tasks = self.server.jobs[job]
+            if polls <= POLLS_BEFORE_FINISHED:
+                self.send_json({"data": {"id": parts[1], "status": "processing", "tasks": []}})
+                return
+            self.send_json({"data": {"id": parts[1], "status": "finished", "tasks": [
+                {"name": name, "operation": task["operation"], "result": {"files": [{
+                    "filename": "out.jpg",
+                    "url": f"{self.server.url}/files/{job}/{name.split('-')[1]}"
+                }]}} if task["operation"] == "export/url" else
+                {"name": name, "operation": task["operation"]}
+                for name, task in tasks.items()
+            ]}})
+        elif parts[0] == "files":
+            _, _, uploaded = self.server.uploads[int(parts[1]), int(parts[2])]
+            data = converted_data(uploaded)
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_error(404)
+
+@pytest.fixture
+def server():
+    server = CloudConvertStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the polling delays instead of waiting them out."""
+    delays = []
+    monkeypatch.setattr(fallback_handler.time, "sleep", delays.append)
+    return delays
+
+def make_inputs(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"photo{i}.heic"
+        path.write_bytes(f"heic data {i}".encode())
+        paths.append(str(path))
+    return paths
+
+def test_client_converts_a_batch_in_one_job(tmp_path, server, sleeps, monkeypatch):
+    monkeypatch.setattr(fallback_handler, "CLOUDCONVERT_POLL_INITIAL", 0.5)
+    monkeypatch.setattr(fallback_handler, "CLOUDCONVERT_POLL_MAX", 2)
+    inputs = make_inputs(tmp_path, 3)
+    outputs = [str(tmp_path / f"photo{i}.jpg") for i in range(3)]
+
+    with CloudConvertClient(api_key=API_KEY, api_url=server.url + "/") as client:
+        client.convert(list(zip(inputs, outputs)))
+
+    # One job chaining import, convert and export for every file
+    assert len(server.jobs) == 1
+    assert server.jobs[0] == {
+        task: body
+        for i in range(3)
+        for task, body in (
+            (f"import-{i}", {"operation": "import/upload"}),
+            (f"convert-{i}", {"operation": "convert", "input": f"import-{i}", "output_format": "jpg"}),
+            (f"export-{i}", {"operation": "export/url", "input": f"convert-{i}"})
+        )
+    }
+    # Each upload carries its task's signed form parameters and the file
+    for i, input_path in enumerate(inputs):
+        fields, name, data = server.uploads[0, i]
+        assert fields == {"expires": "3600", "signature": f"sig-import-{i}"}
+        assert name == "file"
+        assert data == f"heic data {i}".encode()
+    # Polling backs off exponentially up to the cap
+    assert sleeps == [0.5, 1, 2, 2]
+    assert server.polls == {0: POLLS_BEFORE_FINISHED + 1}
+    # Downloads are streamed to disk whole, over several chunks
+    for i, output_path in enumerate(outputs):
+        with open(output_path, "rb") as f:
+            data = f.read()
+        assert len(data) > CONVERTED_BYTES
+        assert data == converted_data(f"heic data {i}".encode())
+    # Only API calls carry the key; upload and download URLs are signed
+    for method, path, authorization in server.requests:
+        if path.startswith("/jobs"):
+            assert authorization == f"Bearer {API_KEY}"
+        else:
+            assert authorization is None
+
+def test_batches_split_by_batch_size(tmp_path, server, sleeps, monkeypatch):
+    monkeypatch.setattr(fallback_handler, "CLOUDCONVERT_API_URL", server.url)
+    monkeypatch.setattr(fallback_handler, "CLOUDCONVERT_API_KEY", API_KEY)
+    monkeypatch.setattr(fallback_handler, "CLOUDCONVERT_BATCH_SIZE", 2)
+    inputs = make_inputs(tmp_path, 5)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+
+    converted = convert_heic_batch_with_cloudconvert(inputs, str(output_dir))
+
+    assert [len(tasks) // 3 for tasks in server.jobs] == [2, 2, 1]
+    assert list(converted) == inputs
+    for i, input_path in enumerate(inputs):
+        assert converted[input_path].startswith(str(output_dir))
+        with open(converted[input_path], "rb") as f:
+            assert f.read() == converted_data(f"heic data {i}".encode())
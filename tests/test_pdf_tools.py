@@ -0,0 +1,184 @@
+import re
+import struct
+from io import BytesIO
+
+import pytest
+from fpdf import FPDF
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import (
+    ArrayObject, DictionaryObject, NameObject, NumberObject, TextStringObject
+)
+
+import fallback_handler
+from pdf_tools import (
+    append_pages, find_startxref, merge_documents, uses_xref_table
+)
+
+def make_pdf(labels):
+    """Return PDF bytes with one page per label, showing the label."""
+    pdf = FPDF()
+    pdf.set_font("Helvetica", size=12)
+    for label in labels:
+        pdf.add_page()
+        pdf.text(20, 20, label)
+    return bytes(pdf.output())
+
+def make_structured_pdf(labels, outline=(), dests=(), fields=()):
+    """Return PDF bytes with bookmarks, named destinations and text fields.
+
+    outline and dests are (title, page index) pairs, fields (name, page
+    index) pairs placing a text field widget on that page.
+    """
+    writer = PdfWriter()
+    for page in PdfReader(BytesIO(make_pdf(labels))).pages:
+        writer.add_page(page)
+    for title, page_index in outline:
+        writer.add_outline_item(title, page_index)
+    for name, page_index in dests:
+        writer.add_named_destination(name, page_index)
+    field_refs = ArrayObject()
+    for name, page_index in fields:
+        field_ref = writer._add_object(DictionaryObject({
+            NameObject("/Type"): NameObject("/Annot"),
+            NameObject("/Subtype"): NameObject("/Widget"),
+            NameObject("/FT"): NameObject("/Tx"),
+            NameObject("/T"): TextStringObject(name),
+            NameObject("/Rect"): ArrayObject(NumberObject(v) for v in (50, 50, 200, 80))
+        }))
+        writer.pages[page_index][NameObject("/Annots")] = ArrayObject([field_ref])
+        field_refs.append(field_ref)
+    if field_refs:
+        writer._root_object[NameObject("/AcroForm")] = DictionaryObject({
+            NameObject("/Fields"): field_refs
+        })
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+def write_xref_stream_pdf(path, count):
+    """Write a PDF of count blank pages whose cross-reference is a stream."""
+    kids = " ".join(f"{3 + i} 0 R" for i in range(count))
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{kids}] /Count {count} >>".encode()
+    ] + [b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] >>"] * count
+    data = bytearray(b"%PDF-1.5\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref_number = len(objects) + 1
+    offsets.append(len(data))
+    # Type, offset and generation of objects 0 to xref_number
+    entries = struct.pack(">BIH", 0, 0, 65535) + b"".join(
+        struct.pack(">BIH", 1, offset, 0) for offset in offsets
+    )
+    data += (
+        f"{xref_number} 0 obj\n<< /Type /XRef /Size {xref_number + 1} "
+        f"/W [1 4 2] /Root 1 0 R /Length {len(entries)} >>\nstream\n"
+    ).encode() + entries + b"\nendstream\nendobj\n"
+    data += f"startxref\n{offsets[-1]}\n%%EOF\n".encode()
+    with open(path, "wb") as f:
+        f.write(data)
+
+def page_texts(path):
+    return [page.extract_text().strip() for page in PdfReader(path).pages]
+
+def xref_chain(path):
+    """Return the offsets of the xref sections of a PDF, newest first."""
+    with open(path, "rb") as f:
+        offset = find_startxref(f)
+        f.seek(0)
+        data = f.read()
+    chain = []
+    while offset is not None:
+        assert data[offset:offset + 4] == b"xref"
+        chain.append(offset)
+        trailer = data[data.index(b"trailer", offset):data.index(b"startxref", offset)]
+        match = re.search(rb"/Prev (\d+)", trailer)
+        offset = int(match.group(1)) if match else None
+    return chain
+
+def test_append_pages_round_trip(tmp_path):
+    target = str(tmp_path / "target.pdf")
+    with open(target, "wb") as f:
+        f.write(make_pdf(["Page 1", "Page 2", "Page 3"]))
+    with open(target, "rb") as f:
+        original = f.read()
+    original_xref = xref_chain(target)
+
+    assert append_pages(target, make_pdf(["Page 4", "Page 5"])) == 2
+    first_update = xref_chain(target)
+    new_page = str(tmp_path / "new.pdf")
+    with open(new_page, "wb") as f:
+        f.write(make_pdf(["Page 6"]))
+    assert append_pages(target, new_page) == 1
+
+    # Incremental updates leave the existing bytes alone
+    with open(target, "rb") as f:
+        assert f.read().startswith(original)
+    chain = xref_chain(target)
+    assert len(chain) == 3
+    assert chain[1:] == first_update
+    assert chain[-1:] == original_xref
+    assert len(PdfReader(target).pages) == 6
+    assert page_texts(target) == [f"Page {n}" for n in range(1, 7)]
+
+def test_append_pages_refuses_document_structure(tmp_path):
+    target = str(tmp_path / "target.pdf")
+    with open(target, "wb") as f:
+        f.write(make_pdf(["Page 1"]))
+    with open(target, "rb") as f:
+        original = f.read()
+
+    with pytest.raises(ValueError):
+        append_pages(target, make_structured_pdf(["Page 2"], outline=[("two", 0)]))
+    with open(target, "rb") as f:
+        assert f.read() == original
+
+def test_merge_keeps_outlines_names_and_forms(tmp_path):
+    first = make_structured_pdf(
+        ["A1", "A2", "A3"], outline=[("a-one", 0), ("a-three", 2)],
+        dests=[("a-dest", 1)], fields=[("a_field", 0)]
+    )
+    second = str(tmp_path / "second.pdf")
+    with open(second, "wb") as f:
+        f.write(make_structured_pdf(
+            ["B1", "B2"], outline=[("b-two", 1)],
+            dests=[("b-dest", 0), ("a-dest", 1)], fields=[("b_field", 1)]
+        ))
+    output = str(tmp_path / "merged.pdf")
+
+    assert merge_documents([first, second], output) == 5
+    reader = PdfReader(output)
+    assert page_texts(output) == ["A1", "A2", "A3", "B1", "B2"]
+    assert [
+        (item.title, reader.get_destination_page_number(item)) for item in reader.outline
+    ] == [("a-one", 0), ("a-three", 2), ("b-two", 4)]
+    # The first document wins a name both define
+    assert {
+        name: reader.get_destination_page_number(dest)
+        for name, dest in reader.named_destinations.items()
+    } == {"a-dest": 1, "b-dest": 3}
+    assert set(reader.get_fields()) == {"a_field", "b_field"}
+    assert [
+        [annot.get_object()["/T"] for annot in page.get("/Annots", [])]
+        for page in reader.pages
+    ] == [["a_field"], [], [], [], ["b_field"]]
+
+def test_xref_stream_target_is_rewritten(tmp_path):
+    target = str(tmp_path / "target.pdf")
+    write_xref_stream_pdf(target, 1)
+    with open(target, "rb") as f:
+        original = f.read()
+        assert not uses_xref_table(f, find_startxref(f))
+
+    with pytest.raises(ValueError):
+        append_pages(target, make_pdf(["new 1", "new 2"]))
+    with open(target, "rb") as f:
+        assert f.read() == original
+
+    fallback_handler.append_to_pdf(target, make_pdf(["new 1", "new 2"]))
+    with open(target, "rb") as f:
+        assert uses_xref_table(f, find_startxref(f))
+    assert page_texts(target) == ["", "new 1", "new 2"]
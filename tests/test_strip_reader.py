@@ -0,0 +1,110 @@
+import pytest
+from PIL import Image
+
+import fallback_handler
+import strip_reader
+from strip_reader import PngRows, RawRows, TiffRows, open_rows
+
+WIDTH, HEIGHT = 37, 53
+# Overlapping bands, top to bottom, the way prepare_tiled_page() asks for them
+BANDS = [(0, 7), (5, 20), (20, 40), (38, HEIGHT)]
+
+def make_image(mode, colors=None):
+    """Return a noisy WIDTH x HEIGHT image in mode, paletted to colors if given."""
+    gray = Image.effect_noise((WIDTH, HEIGHT), 80).convert("L")
+    if mode == "I;16":
+        return Image.frombytes(
+            mode, (WIDTH, HEIGHT), bytes(i * 7 % 256 for i in range(WIDTH * HEIGHT * 2))
+        )
+    rgba = Image.merge("RGBA", (
+        gray, gray.rotate(90), gray.transpose(Image.FLIP_LEFT_RIGHT),
+        gray.transpose(Image.FLIP_TOP_BOTTOM)
+    ))
+    if mode == "P":
+        return rgba.convert("RGB").quantize(colors or 200)
+    return rgba.convert(mode)
+
+def check_bands(path, reader_type):
+    """Check that every band read matches the same rows of a whole decode."""
+    with Image.open(path) as whole:
+        whole.load()
+        with Image.open(path) as image:
+            reader = open_rows(image, path)
+            try:
+                assert isinstance(reader, reader_type)
+                for top, bottom in BANDS:
+                    band = reader.read(top, bottom)
+                    assert band.mode == whole.mode
+                    assert band.size == (WIDTH, bottom - top)
+                    assert band.tobytes() == whole.crop((0, top, WIDTH, bottom)).tobytes()
+            finally:
+                reader.close()
+
+@pytest.mark.parametrize("mode, colors", [
+    ("1", None), ("L", None), ("I;16", None), ("RGB", None), ("LA", None),
+    ("RGBA", None), ("P", None), ("P", 2), ("P", 4), ("P", 16)
+])
+def test_png_bands_match_whole_decode(tmp_path, monkeypatch, mode, colors):
+    # Inflate a few rows at a time so bands span several decode steps
+    monkeypatch.setattr(strip_reader, "PNG_BAND_BYTES", 64)
+    path = str(tmp_path / "image.png")
+    make_image(mode, colors).save(path)
+    check_bands(path, PngRows)
+
+@pytest.mark.parametrize("mode", ["1", "L", "P", "RGB", "RGBA"])
+def test_bmp_bands_match_whole_decode(tmp_path, mode):
+    path = str(tmp_path / "image.bmp")
+    make_image(mode).save(path)
+    check_bands(path, RawRows)
+
+@pytest.mark.parametrize("mode", ["1", "L", "LA", "I;16", "P", "RGB", "RGBA", "CMYK"])
+def test_uncompressed_tiff_bands_match_whole_decode(tmp_path, mode):
+    path = str(tmp_path / "image.tif")
+    make_image(mode).save(path)
+    check_bands(path, RawRows)
+
+@pytest.mark.parametrize("mode, compression", [
+    ("L", "tiff_lzw"), ("L", "tiff_adobe_deflate"), ("L", "packbits"),
+    ("RGB", "tiff_lzw"), ("RGB", "tiff_adobe_deflate"), ("RGB", "packbits"),
+    ("1", "group4")
+])
+def test_compressed_tiff_bands_match_whole_decode(tmp_path, mode, compression):
+    path = str(tmp_path / "image.tif")
+    # Small strips so a band covers several of them
+    make_image(mode).save(path, compression=compression, strip_size=400)
+    check_bands(path, TiffRows)
+
+def convert(tmp_path, monkeypatch, image, pdf_options):
+    """Convert one image on its own and return (result, PDF page count)."""
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "in").mkdir()
+    image.save(tmp_path / "in" / "image.png")
+    result = fallback_handler.convert_folder_to_pdf(
+        "in", "out.pdf", pdf_options=pdf_options, workers=1,
+        use_page_cache=False, skip_converted=False
+    )
+    return result, fallback_handler.count_pdf_pages(result['output'])
+
+def test_split_long_image_reports_pdf_pages(tmp_path, monkeypatch):
+    # Nine times wider than tall: 13 pages the shape of the A4 image box
+    panorama = Image.effect_noise((1800, 200), 40).convert("RGB")
+    result, pages = convert(tmp_path, monkeypatch, panorama, {'split_long_images': True})
+    assert pages == 13
+    assert result['pages'] == 13
+    assert result['metrics']['pages'] == 13
+
+def test_tiled_image_stays_on_one_page(tmp_path, monkeypatch):
+    monkeypatch.setattr(fallback_handler, "TILED_MIN_PIXELS", 10000)
+    monkeypatch.setattr(fallback_handler, "TILE_BYTES", 300 * 4 * 50)
+    image = Image.effect_noise((300, 400), 40).convert("RGB")
+    image.save(tmp_path / "big.png")
+
+    pieces, _, _, _ = fallback_handler.prepare_page(str(tmp_path / "big.png"), 85)
+    assert len(pieces) == 1
+    _, tiles = pieces[0]
+    assert len(tiles) == 8
+    assert sum(h for _, (_, _, _, h) in tiles) == 400
+
+    result, pages = convert(tmp_path, monkeypatch, image, {})
+    assert pages == 1
+    assert result['pages'] == 1
@@ -0,0 +1,161 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+from fallback_handler import (
+    SUPPORTED_FORMATS, ConversionError, convert_folder_to_pdf, walk_directory
+)
+
+# Seconds without new events before a burst of arrivals is handled
+WATCH_DEBOUNCE = 2.0
+# Seconds a file's size and mtime must stay unchanged before it is read
+WATCH_SETTLE = 3.0
+# Seconds between directory checks when watchdog is not installed
+WATCH_POLL_INTERVAL = 5.0
+# Shortest wait for events, so a zero debounce or settle does not spin
+WATCH_MIN_WAIT = 0.05
+
+def start_watchdog(folder, recursive, events):
+    """Report created, modified and moved-in paths with watchdog (inotify on Linux).
+
+    Returns the running observer, or None when watchdog is not installed.
+    """
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        return None
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory or event.event_type not in ("created", "modified", "moved", "closed"):
+                return
+            events.put(getattr(event, 'dest_path', None) or event.src_path)
+
+    observer = Observer()
+    observer.schedule(Handler(), folder, recursive=recursive)
+    observer.start()
+    return observer
+
+def poll_folder(folder, supported_formats, recursive, events, stop_event,
+                interval=WATCH_POLL_INTERVAL):
+    """Report new or changed files by comparing directory listings.
+
+    Only stats files; nothing is read or hashed here.
+    """
+    def snapshot():
+        found, _ = walk_directory(folder, supported_formats, recursive)
+        return {path: (st.st_size, st.st_mtime_ns) for path, st in found}
+
+    previous = snapshot()
+    while not stop_event.wait(interval):
+        current = snapshot()
+        for path, stamp in current.items():
+            if previous.get(path) != stamp:
+                events.put(path)
+        previous = current
+
+def get_stamp(path):
+    """Return (size, mtime_ns) of a file, or None if it is gone."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+def watch_folder(input_folder, output_pdf, supported_formats=SUPPORTED_FORMATS,
+                 recursive=True, debounce=WATCH_DEBOUNCE, settle=WATCH_SETTLE,
+                 poll_interval=WATCH_POLL_INTERVAL, stop_event=None,
+                 catch_up=True, on_result=None, metrics_factory=None,
+                 **conversion_kwargs):
+    """Convert files as they land in input_folder until stop_event is set.
+
+    Arrivals are collected from watchdog when it is installed, otherwise
+    by polling. Once no event has come in for debounce seconds, the files
+    whose size and mtime have not changed for settle seconds are converted
+    and appended to output_pdf; files still being written wait for the
+    next round. Only those files are fingerprinted, and the conversion
+    history still skips anything already converted. With catch_up, files
+    that arrived while nobody was watching are converted first with a
+    normal scan. on_result(result) gets every conversion result, and
+    metrics_factory() is called for a fresh ConversionMetrics per run;
+    conversion_kwargs go to convert_folder_to_pdf().
+    """
+    stop_event = stop_event or threading.Event()
+    conversion_kwargs.setdefault('append', True)
+    conversion_kwargs.setdefault('skip_converted', True)
+    supported_formats = tuple(supported_formats)
+
+    def convert(files=None):
+        try:
+            result = convert_folder_to_pdf(
+                input_folder, output_pdf, supported_formats=supported_formats,
+                recursive=recursive, files=files,
+                metrics=metrics_factory() if metrics_factory else None,
+                **conversion_kwargs
+            )
+        except ConversionError as e:
+            # Keep watching; the error report has the details
+            logging.error(f"Watch conversion failed: {e}")
+            return
+        if result['status'] == 'converted':
+            logging.info(f"Watch mode added {result['pages']} pages to {result['output']}")
+        if on_result:
+            on_result(result)
+
+    if catch_up:
+        convert()
+
+    events = queue.Queue()
+    observer = start_watchdog(input_folder, recursive, events)
+    poller = None
+    if observer is None:
+        logging.info(f"watchdog not installed; polling {input_folder} every {poll_interval}s")
+        poller = threading.Thread(
+            target=poll_folder,
+            args=(input_folder, supported_formats, recursive, events, stop_event, poll_interval),
+            daemon=True
+        )
+        poller.start()
+
+    # path -> (size, mtime_ns, when that stamp was first seen)
+    pending = {}
+    last_event = 0.0
+    try:
+        while not stop_event.is_set():
+            try:
+                path = events.get(timeout=max(WATCH_MIN_WAIT, min(debounce, settle) / 2))
+                while True:
+                    if path.lower().endswith(supported_formats):
+                        pending.setdefault(path, None)
+                        last_event = time.monotonic()
+                    path = events.get_nowait()
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            if not pending or now - last_event < debounce:
+                continue
+
+            ready = []
+            for path, seen in list(pending.items()):
+                stamp = get_stamp(path)
+                if stamp is None:
+                    del pending[path]
+                elif seen is None or seen[:2] != stamp:
+                    pending[path] = stamp + (now,)
+                elif now - seen[2] >= settle:
+                    ready.append(path)
+                    del pending[path]
+            if ready:
+                logging.info(f"Watch mode converting {len(ready)} new files")
+                convert(sorted(ready))
+    finally:
+        stop_event.set()
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        if poller is not None:
+            poller.join()